@@ -0,0 +1,99 @@
+import argparse, os, random
+from multiprocessing import Pool
+
+# === my imports ===
+import constants as C
+from room_library import load_rooms, LIBRARY_FILE
+from dungeon_generator import Dungeon
+from utilities import derive_seed
+from node_sources import load_layout
+from pattern_cache import PatternCache
+from budget import Budget, BUDGET_REASONS
+from dungeon_file import write_dungeon
+
+# Set in each worker by init_worker, so the room library is loaded once per process
+worker_rooms = None
+worker_cache = None  # Pattern cache shared by the worker's dungeons, if the batch has one
+
+class BatchResult(object):
+    """
+    # What a worker sends back for one seed
+    # Placements are (x, y, room name) in chunk space; tiles is the main grid
+    # as tile codes, row by row (None if generation failed)
+    # Status is the Dungeon's; a dungeon that ran out of budget still has the tiles of its best partial grid
+    """
+    def __init__(self, seed, success, placements, width, height, tiles, status=None):
+        self.seed = seed
+        self.success = success
+        self.status = status
+        self.placements = placements
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+
+    def __repr__(self):
+        return 'Seed: %s, Status: %s, Chunks: %d' % (self.seed, self.status, len(self.placements))
+
+def init_worker(room_pattern, library_file, cache_file=None):
+    global worker_rooms, worker_cache
+    # Workers run quietly, and never write debug images or files
+    C.DEBUG = False
+    C.IM_DEBUG = False
+    worker_rooms = load_rooms(room_pattern, library_file)
+    if cache_file:
+        worker_cache = PatternCache(fp=cache_file)
+
+def generate_one(args):
+    node_map, seed, budget, output_dir = args
+    dungeon = Dungeon(worker_rooms, node_map, random.Random(seed), pattern_cache=worker_cache, budget=budget)
+    if worker_cache and worker_cache.changed:
+        worker_cache.save()
+    if output_dir:
+        write_dungeon(os.path.join(output_dir, 'dungeon_%d.dgn' % seed), dungeon)
+    return make_result(seed, dungeon)
+
+def make_result(seed, dungeon):
+    chunks = dungeon.best_chunks if dungeon.status in BUDGET_REASONS else dungeon.chunk_grid.chunks.items()
+    placements = [(pos[0], pos[1], chunk.name) for pos, chunk in chunks]
+    grid = dungeon.main_grid
+    if grid:
+        return BatchResult(seed, dungeon.success, placements, grid.width, grid.height, bytes(grid.grid), dungeon.status)
+    return BatchResult(seed, False, placements, 0, 0, None, dungeon.status)
+
+def generate_batch(node_map, seeds, room_pattern='Rooms/*.png', library_file=LIBRARY_FILE, processes=None, cache_file=None, budget=None, output_dir=None):
+    """
+    # Generates one dungeon per seed across a process pool
+    # Yields a BatchResult as each dungeon finishes, so not in seed order
+    # With a cache_file, workers share solved connection patterns through it. That
+    # makes them faster, but a dungeon then depends on what was in the cache, not just its seed
+    # A budget (see budget.py) bounds how long any one seed can hold up a worker
+    # With an output_dir, workers also save every dungeon there as dungeon_<seed>.dgn (see dungeon_file.py)
+    """
+    # Build the room library up front, so workers only ever read it
+    load_rooms(room_pattern, library_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    # Same for the node graph, so it is read once rather than once per seed
+    layout = load_layout(node_map)
+    with Pool(processes, initializer=init_worker, initargs=(room_pattern, library_file, cache_file)) as pool:
+        for result in pool.imap_unordered(generate_one, [(layout, seed, budget, output_dir) for seed in seeds]):
+            yield result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate many dungeons from one node map')
+    parser.add_argument('node_map', nargs='?', default='NodeMap.png', help='Node map image, or a .txt or .graph node graph')
+    parser.add_argument('-n', '--num', type=int, default=10, help='Number of dungeons')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='Batch seed to derive each dungeon seed from; otherwise seeds are 0 to n-1')
+    parser.add_argument('-p', '--processes', type=int, default=None)
+    parser.add_argument('-c', '--cache', default=None, help='Pattern cache file to share between workers and batches')
+    parser.add_argument('-t', '--time', type=float, default=None, help='Seconds each dungeon gets before keeping what it has')
+    parser.add_argument('-o', '--output-dir', default=None, help='Save every dungeon here in the binary format of dungeon_file.py')
+    parser.add_argument('-r', '--restarts', type=int, default=0, help='Times a dungeon that gets stuck starts over with a new seed')
+    args = parser.parse_args()
+    if args.seed is None:
+        seeds = list(range(args.num))
+    else:
+        seeds = [derive_seed(args.seed, idx) for idx in range(args.num)]
+    budget = Budget(args.time, restarts=args.restarts) if args.time or args.restarts else None
+    for result in generate_batch(args.node_map, seeds, processes=args.processes, cache_file=args.cache, budget=budget, output_dir=args.output_dir):
+        print(result)
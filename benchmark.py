@@ -0,0 +1,123 @@
+import argparse, contextlib, glob, io, json, multiprocessing, os, random, sys, time, tracemalloc
+from PIL import Image
+
+# === my imports ===
+import constants as C
+from chunk_objects import grid_to_image
+from dungeon_generator import Dungeon
+from room_library import build_rooms, hash_room_files, write_library, read_library
+from node_sources import random_lattice
+
+# Name, lattice width, lattice height, branching, extra edge ratio (see random_lattice)
+CASES = [('corridor-small', 6, 6, 0.0, 0.0),
+         ('tree-small', 6, 6, 0.5, 0.0),
+         ('loops-small', 6, 6, 0.5, 0.1),
+         ('corridor-medium', 12, 12, 0.0, 0.0),
+         ('tree-medium', 12, 12, 0.5, 0.0),
+         ('branchy-medium', 12, 12, 1.0, 0.0),
+         ('loops-medium', 12, 12, 0.5, 0.1),
+         ('tree-large', 24, 24, 0.5, 0.0),
+         ('loops-large', 24, 24, 0.5, 0.05)]
+
+def make_node_map(width, height, branching, extra_edges, rng):
+    """
+    # Node map image of random_lattice, for timing the image path
+    # Lattice points are 4 pixels apart, with a node between every connected pair,
+    # so nodes are only adjacent along the chosen edges
+    """
+    layout = random_lattice(width, height, branching, extra_edges, rng)
+    im = Image.new('RGB', (width * 4 + 3, height * 4 + 3), (255, 255, 255))
+    for pos in layout.adjacency:
+        im.putpixel(pos, (0, 0, 0))
+    return im
+
+@contextlib.contextmanager
+def stage(results, name, memory):
+    if memory:
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:  # Before Python 3.9; restarting clears the peak too, along with the traces so far
+            tracemalloc.stop()
+            tracemalloc.start()
+    start = time.perf_counter()
+    yield
+    results[name] = {'time': time.perf_counter() - start}
+    if memory:
+        results[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+
+def run_case(room_pattern, name, width, height, branching, extra_edges, seed, memory):
+    # Runs in its own process, so memory peaks don't carry over between cases
+    C.DEBUG = False
+    C.IM_DEBUG = False
+    if memory:
+        tracemalloc.start()
+    rooms = build_rooms(glob.glob(room_pattern))
+    node_map = io.BytesIO()
+    make_node_map(width, height, branching, extra_edges, random.Random(seed)).save(node_map, 'PNG')
+    stages = {}
+    dungeon = Dungeon(rooms, node_map, random.Random(seed), build=False)
+    with stage(stages, 'build_node_graph', memory):
+        node_map.seek(0)
+        dungeon.build_node_graph(node_map)
+    with stage(stages, 'build_chunk_grid', memory):
+        success = dungeon.build_chunk_grid()
+    if success:
+        with stage(stages, 'build_main_grid', memory):
+            dungeon.build_main_grid()
+        with stage(stages, 'draw', memory):
+            grid_to_image(dungeon.main_grid, 5).save(io.BytesIO(), 'PNG')
+    if memory:
+        tracemalloc.stop()
+    return {'case': name,
+            'seed': seed,
+            'nodes': len(dungeon.nodes),
+            'success': success,
+            'counters': dungeon.metrics.counters.as_dict(),
+            'stages': stages}
+
+def run_benchmarks(cases=CASES, seeds=(0, 1, 2), room_pattern='Rooms/*.png', memory=True, timeout=60):
+    """
+    # Yields one result dictionary for room loading, then one per case and seed
+    # Generation has no step limit, so a case that runs past timeout seconds
+    # is stopped and reported with success None
+    """
+    C.DEBUG = False
+    C.IM_DEBUG = False
+    if memory:
+        tracemalloc.start()
+    paths = glob.glob(room_pattern)
+    room_stages = {}
+    with stage(room_stages, 'build_rooms', memory):
+        rooms = build_rooms(paths)
+    library_file = 'benchmark_rooms.%d.lib' % os.getpid()
+    write_library(library_file, hash_room_files(paths), rooms)
+    with stage(room_stages, 'read_library', memory):
+        read_library(library_file)
+    os.remove(library_file)
+    if memory:
+        tracemalloc.stop()
+    yield {'case': 'rooms', 'rooms': len(rooms), 'stages': room_stages}
+    for name, width, height, branching, extra_edges in cases:
+        for seed in seeds:
+            with multiprocessing.Pool(1) as pool:
+                result = pool.apply_async(run_case, (room_pattern, name, width, height, branching, extra_edges, seed, memory))
+                try:
+                    yield result.get(timeout)
+                except multiprocessing.TimeoutError:
+                    yield {'case': name, 'seed': seed, 'success': None, 'timeout': timeout}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of dungeon generation on synthetic node maps')
+    parser.add_argument('-c', '--case', action='append', help='Only run these cases (by name)')
+    parser.add_argument('-s', '--seeds', type=int, default=3, help='Seeds 0 to n-1 for every case')
+    parser.add_argument('--no-memory', action='store_true', help='Skip tracemalloc, which slows every stage down')
+    parser.add_argument('-t', '--timeout', type=float, default=60, help='Seconds before a case is given up on')
+    parser.add_argument('-o', '--output', default=None, help='Write JSON lines here instead of stdout')
+    args = parser.parse_args()
+    cases = [case for case in CASES if not args.case or case[0] in args.case]
+    out = open(args.output, 'w') if args.output else sys.stdout
+    for result in run_benchmarks(cases, range(args.seeds), memory=not args.no_memory, timeout=args.timeout):
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+    if args.output:
+        out.close()
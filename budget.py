@@ -0,0 +1,41 @@
+import time
+
+# Why a dungeon stopped early, as Dungeon.status
+BUDGET_REASONS = ('time', 'attempts', 'backtracks')
+
+class Budget(object):
+    """
+    # Limits on how long one dungeon gets, so an unlucky seed can't stall its caller
+    # time is wall-clock seconds for the whole dungeon, restarts included
+    # attempts (calls to choose_room, or solver values tried) and backtracks are per try;
+    # running out of either, or failing outright, starts over with a new seed
+    # derived from the old one, up to restarts times
+    # None means no limit
+    """
+    def __init__(self, time=None, attempts=None, backtracks=None, restarts=0):
+        self.time = time
+        self.attempts = attempts
+        self.backtracks = backtracks
+        self.restarts = restarts
+        self.started = None
+        self.attempts_at = 0  # Counters when this try started
+        self.backtracks_at = 0
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def start_try(self, counters):
+        self.attempts_at = counters.attempts
+        self.backtracks_at = counters.backtracks
+
+    def check(self, counters):
+        # Returns the limit that ran out, or None
+        if self.started is None:
+            self.start()  # Building without start_steps, e.g. build_chunk_grid on its own
+        if self.time is not None and time.perf_counter() - self.started >= self.time:
+            return 'time'
+        if self.attempts is not None and counters.attempts - self.attempts_at >= self.attempts:
+            return 'attempts'
+        if self.backtracks is not None and counters.backtracks - self.backtracks_at >= self.backtracks:
+            return 'backtracks'
+        return None
@@ -1,4 +1,68 @@
+import hashlib
+from PIL import Image, ImageChops
+
 import constants as C
+from utilities import opposite
+
+# Tiles are stored as their index into this tuple; 0 is an unset tile
+TILES = (None, 'Wall', 'Exit', 'Void', 'Empty')
+TILE_CODES = {tile: code for code, tile in enumerate(TILES)}
+
+# Per-band lookup tables chosen so that the sum of the three bands is unique
+# for black (0), exit red (1) and void grey (7); anything else sums past 8
+RED_TABLE = [0 if v == 0 else 1 if v == 200 else 9 for v in range(256)]
+GREEN_TABLE = [0 if v == 0 else 2 if v == 200 else 9 for v in range(256)]
+BLUE_TABLE = [0 if v == 0 else 4 if v == 200 else 9 for v in range(256)]
+SUM_TABLE = [TILE_CODES['Empty'] for _ in range(256)]
+SUM_TABLE[0] = TILE_CODES['Wall']
+SUM_TABLE[1] = TILE_CODES['Exit']
+SUM_TABLE[7] = TILE_CODES['Void']
+
+# Colour of each tile code, in the order of TILES
+TILE_PALETTE = [200, 200, 200,  # Unset
+                0, 0, 0,  # Wall
+                200, 0, 0,  # Exit
+                200, 200, 200,  # Void
+                248, 248, 248]  # Empty
+# Character of each tile code in text output
+TEXT_TABLE = bytes(ord('*') if code == TILE_CODES['Wall'] else ord(' ') for code in range(256))
+
+def classify_image(image):
+    """
+    # Returns the tile code of every pixel in the image as bytes, row by row
+    # The whole image is classified at once with band lookup tables,
+    # instead of calling getpixel on each pixel
+    """
+    red, green, blue = image.convert('RGB').split()
+    total = ImageChops.add(ImageChops.add(red.point(RED_TABLE), green.point(GREEN_TABLE)), blue.point(BLUE_TABLE))
+    return total.point(SUM_TABLE).tobytes()
+
+def grid_to_image(grid, scale=1):
+    """
+    # Palette image of a TileGrid, built from its bytes in one call
+    # Each tile becomes a scale x scale block without a separate resize
+    """
+    data = grid.grid
+    width, height = grid.width * scale, grid.height * scale
+    if scale > 1:
+        wide = bytearray(len(data) * scale)
+        for k in range(scale):
+            wide[k::scale] = data
+        data = b''.join(wide[y*width:(y + 1)*width] * scale for y in range(grid.height))
+    im = Image.frombytes('P', (width, height), bytes(data))
+    im.putpalette(TILE_PALETTE)
+    return im
+
+def grid_to_text(grid):
+    # '*' for walls and ' ' for everything else, one line per row
+    text = bytes(grid.grid).translate(TEXT_TABLE).decode('ascii')
+    width = grid.width
+    return ''.join(text[y*width:(y + 1)*width] + '\n' for y in range(grid.height))
+
+def load_tile_grid(image):
+    grid = TileGrid(image.size)
+    grid.grid = bytearray(classify_image(image))
+    return grid
 
 class Grid(object):
     def __init__(self, size):
@@ -19,73 +83,89 @@ class Grid(object):
                 tile = grid.get(x, y)
                 self.set(offset_x + x, offset_y + y, tile)
 
+class TileGrid(Grid):
+    """
+    # Grid of tiles stored one byte per tile in a bytearray
+    # get and set still deal in tile names
+    """
+    def __init__(self, size):
+        self.width, self.height = size
+        self.width = int(self.width)
+        self.height = int(self.height)
+        self.grid = bytearray(self.width*self.height)
+
+    def set(self, x, y, tile):
+        self.grid[y*self.width + x] = TILE_CODES[tile]
+
+    def get(self, x, y):
+        return TILES[self.grid[y*self.width + x]]
+
+    def set_code(self, x, y, code):
+        self.grid[y*self.width + x] = code
+
+    def get_code(self, x, y):
+        return self.grid[y*self.width + x]
+
+    def subsume(self, offset_x, offset_y, grid):
+        # Copies whole rows at a time
+        width = grid.width
+        for y in range(grid.height):
+            start = (offset_y + y)*self.width + offset_x
+            self.grid[start:start + width] = grid.grid[y*width:(y + 1)*width]
+
 class Exit(object):
-    def __init__(self, direction, pos):
+    __slots__ = ('direction', 'pos', '_edge', 'room')
+
+    def __init__(self, direction, pos, room=None):
         self.direction = direction
         self.pos = pos
-        self.edge = None
+        self._edge = None
+        self.room = room  # Whose unchunked exits to update when this is connected
+
+    @property
+    def edge(self):
+        return self._edge
+
+    @edge.setter
+    def edge(self, edge):
+        was_connected = bool(self._edge)
+        self._edge = edge
+        if self.room is not None and bool(edge) != was_connected:
+            self.room.update_unchunked(self.direction)
 
     def __repr__(self):
         return 'Exit Direction: %s, Pos: %s, Edge: %s' % (self.direction, self.pos, self.edge)
 
-class Room(Grid):
-    def __init__(self, image, name):
-        self.image = image
-        self.name = name
-        Grid.__init__(self, image.size)
-        self.c_width = self.width//C.CHUNK_SIZE
-        self.c_height = self.height//C.CHUNK_SIZE
-        self.exits = {'up': set(),
-                      'left': set(),
-                      'right': set(),
-                      'down': set()}
-        self.is_subchunk = False
-        self.subchunks = []  # Only non-empty if self.is_subchunk == True
-
-        for x in range(self.width):
-            for y in range(self.height):
-                color = image.getpixel((x, y))
-                # Wall
-                if color[:3] == (0, 0, 0):
-                    self.set(x, y, 'Wall')
-                elif color[:3] == (200, 0, 0):
-                    self.set(x, y, 'Exit')
-                    if x == 0:
-                        self.exits['left'].add(Exit('left', y//C.CHUNK_SIZE))
-                    elif x == self.width - 1:
-                        self.exits['right'].add(Exit('right', y//C.CHUNK_SIZE))
-                    elif y == 0:
-                        self.exits['up'].add(Exit('up', x//C.CHUNK_SIZE))
-                    elif y == self.height - 1:
-                        self.exits['down'].add(Exit('down', x//C.CHUNK_SIZE))
-                elif color[:3] == (200, 200, 200):
-                    self.set(x, y, 'Void')
-                else:
-                    self.set(x, y, 'Empty')
+class RoomExits(object):
+    """
+    # Exit queries shared by room templates and placed rooms
+    # Expects self.exits, self.c_width and self.c_height
+    """
+    __slots__ = ()
 
     def confirm_match(self, offset_x, offset_y, true_pos_x, true_pos_y, direction):
-        my_exits = self.exits[direction]
         if direction == 'left':
-            if offset_x == true_pos_x:
-                for exit in my_exits:
-                    if exit.pos == true_pos_y - offset_y:
-                        return exit
+            if offset_x != true_pos_x:
+                return False
+            pos = true_pos_y - offset_y
         elif direction == 'right':
-            if offset_x + self.c_width == true_pos_x:
-                for exit in my_exits:
-                    if exit.pos == true_pos_y - offset_y:
-                        return exit
+            if offset_x + self.c_width != true_pos_x:
+                return False
+            pos = true_pos_y - offset_y
         elif direction == 'up':
-            if offset_y == true_pos_y:
-                for exit in my_exits:
-                    if exit.pos == true_pos_x - offset_x:
-                        return exit
+            if offset_y != true_pos_y:
+                return False
+            pos = true_pos_x - offset_x
         elif direction == 'down':
-            if offset_y + self.c_height == true_pos_y:
-                for exit in my_exits:
-                    if exit.pos == true_pos_x - offset_x:
-                        return exit
-        return False
+            if offset_y + self.c_height != true_pos_y:
+                return False
+            pos = true_pos_x - offset_x
+        else:
+            return False
+        idx = self.exit_index.get((direction, pos))
+        if idx is None:
+            return False
+        return self.exits[direction][idx]
 
     def get_exit(self, direction, pos):
         if pos < 0:
@@ -93,14 +173,24 @@ class Room(Grid):
                 return [e for e in self.exits[direction] if e.pos == (self.c_height + pos)]
             else:
                 return [e for e in self.exits[direction] if e.pos == (self.c_width + pos)]
-        return [e for e in self.exits[direction] if e.pos == pos][0]
+        return self.exits[direction][self.exit_index[(direction, pos)]]
 
     def get_unchunked_exits(self, direction):
-        return [exit for exit in self.exits[direction] if not exit.edge]
+        # Kept up to date by Exit.edge, so this never scans or allocates
+        return self.unchunked[direction]
+
+    def update_unchunked(self, direction):
+        self.unchunked[direction] = tuple(exit for exit in self.exits[direction] if not exit.edge)
+
+    def get_exit_table(self):
+        return [(direction, exit.pos) for direction in C.DIRECTIONS for exit in self.exits[direction]]
 
     def get_num_exits(self):
         return len(self.exits['up']) + len(self.exits['left']) + len(self.exits['right']) + len(self.exits['down'])
 
+    def get_exit_counts(self):
+        return tuple(len(self.exits[direc]) for direc in C.DIRECTIONS)
+
     def get_other_exit(self, exit):
         # Assumes that room has exactly two exits
         for direc in C.DIRECTIONS:
@@ -111,18 +201,315 @@ class Room(Grid):
         return None
 
     def reset_all_exits(self):
-        for direction, exit_set in self.exits.items():
-            for exit in exit_set:
+        for direction, exit_list in self.exits.items():
+            for exit in exit_list:
                 exit.edge = None
 
+    def __repr__(self):
+        return self.name
+
+class Room(TileGrid, RoomExits):
+    """
+    # Template for a prefab room. Its tiles and exits are never changed;
+    # copy gives a PlacedRoom to put in the chunk grid
+    """
+    def __init__(self, image, name, tiles=None, exit_table=None, weight=1):
+        # tiles (a TileGrid) and exit_table skip reading the image when given
+        self.image = image
+        self.name = name
+        self.weight = weight  # How many of the library's variants have these exact tiles
+        if tiles is None:
+            tiles = load_tile_grid(image)
+        TileGrid.__init__(self, (tiles.width, tiles.height))
+        self.grid = tiles.grid
+        self.c_width = self.width//C.CHUNK_SIZE
+        self.c_height = self.height//C.CHUNK_SIZE
+        self.exits = {'up': [],  # Kept in order along each edge
+                      'left': [],
+                      'right': [],
+                      'down': []}
+
+        if exit_table is None:
+            self.load_exits()
+        else:
+            for direction, pos in exit_table:
+                self.exits[direction].append(Exit(direction, pos))
+        self.exit_table = self.get_exit_table()
+        # (direction, position along that edge), index into self.exits[direction] of the first exit there
+        self.exit_index = {}
+        for direction, exit_list in self.exits.items():
+            for idx, exit in enumerate(exit_list):
+                exit.room = self
+                self.exit_index.setdefault((direction, exit.pos), idx)
+        self.unchunked = {direction: tuple(exit_list) for direction, exit_list in self.exits.items()}
+        # Direction, where its exits meet the next chunk, relative to the room's corner (as ChunkGrid.get_xy_pos)
+        self.exit_points = {direction: frozenset(get_exit_point(self, direction, exit.pos) for exit in exit_list)
+                            for direction, exit_list in self.exits.items()}
+
+    def load_exits(self):
+        # Exits are the exit tiles on the border rows and columns
+        # Corners count as left or right exits
+        exit_code = TILE_CODES['Exit']
+        width, height = self.width, self.height
+        left_column = self.grid[0::width]
+        right_column = self.grid[width - 1::width]
+        top_row = self.grid[1:width - 1]
+        bottom_row = self.grid[(height - 1)*width + 1:height*width - 1]
+        for y in range(height):
+            if left_column[y] == exit_code:
+                self.exits['left'].append(Exit('left', y//C.CHUNK_SIZE))
+            if width > 1 and right_column[y] == exit_code:
+                self.exits['right'].append(Exit('right', y//C.CHUNK_SIZE))
+        for x in range(1, width - 1):
+            if top_row[x - 1] == exit_code:
+                self.exits['up'].append(Exit('up', x//C.CHUNK_SIZE))
+            if height > 1 and bottom_row[x - 1] == exit_code:
+                self.exits['down'].append(Exit('down', x//C.CHUNK_SIZE))
+
+    def copy(self):
+        return PlacedRoom(self)
+
+class PlacedRoom(RoomExits):
+    """
+    # A room placed in the chunk grid
+    # Shares the tiles and sizes of its template and only holds what changes
+    # per placement, so making one costs one Exit per exit
+    """
+    __slots__ = ('template', 'exits', 'exit_index', 'unchunked', 'is_subchunk', 'subchunks')
+
+    def __init__(self, template):
+        self.template = template
+        self.exits = {'up': [],  # Kept in order along each edge
+                      'left': [],
+                      'right': [],
+                      'down': []}
+        for direction, pos in template.exit_table:
+            self.exits[direction].append(Exit(direction, pos, self))
+        self.exit_index = template.exit_index  # Same positions as the template's
+        self.unchunked = {direction: tuple(exit_list) for direction, exit_list in self.exits.items()}
+        self.is_subchunk = False
+        self.subchunks = []  # Only non-empty if self.is_subchunk == True
+
+    @property
+    def name(self):
+        return self.template.name
+
+    @property
+    def image(self):
+        return self.template.image
+
+    @property
+    def width(self):
+        return self.template.width
+
+    @property
+    def height(self):
+        return self.template.height
+
+    @property
+    def c_width(self):
+        return self.template.c_width
+
+    @property
+    def c_height(self):
+        return self.template.c_height
+
+    @property
+    def grid(self):
+        return self.template.grid
+
+    def get(self, x, y):
+        return self.template.get(x, y)
+
+    def get_code(self, x, y):
+        return self.template.get_code(x, y)
+
     def mark_all_exits(self):
         assert self.is_subchunk
-        for direction, exit_set in self.exits.items():
-            for exit in exit_set:
+        for direction, exit_list in self.exits.items():
+            for exit in exit_list:
                 exit.edge = True
 
-    def __repr__(self):
-        return self.name
-
     def copy(self):
-        return Room(self.image, self.name)
+        return PlacedRoom(self.template)
+
+def get_corridor_moves(rooms):
+    """
+    # Every way to carry on from an open exit with one two-exit room, by the side that exit is on
+    # A move is (room, exit to enter by, other exit, side the other exit is on,
+    # room position from the open exit, other exit position from the open exit)
+    # These only depend on the rooms, so tie_loop can search without working positions out
+    """
+    moves = {direc: [] for direc in C.DIRECTIONS}
+    for direc, direc_moves in moves.items():
+        for room in rooms:
+            for first_exit in room.exits[opposite(direc)]:
+                other_exit, other_direction = room.get_other_exit(first_exit)
+                if direc == 'right':
+                    offset = (0, -first_exit.pos)
+                elif direc == 'left':
+                    offset = (-room.c_width, -first_exit.pos)
+                elif direc == 'up':
+                    offset = (-first_exit.pos, -room.c_height)
+                else:
+                    offset = (-first_exit.pos, 0)
+                if other_direction == 'right':
+                    end = (room.c_width, other_exit.pos)
+                elif other_direction == 'left':
+                    end = (0, other_exit.pos)
+                elif other_direction == 'up':
+                    end = (other_exit.pos, 0)
+                else:
+                    end = (other_exit.pos, room.c_height)
+                direc_moves.append((room, first_exit, other_exit, other_direction, offset, (offset[0] + end[0], offset[1] + end[1])))
+    return moves
+
+def get_exit_point(room, direction, pos):
+    if direction == 'up':
+        return (pos, 0)
+    elif direction == 'down':
+        return (pos, room.c_height)
+    elif direction == 'left':
+        return (0, pos)
+    elif direction == 'right':
+        return (room.c_width, pos)
+
+def hash_rooms(rooms):
+    # Short hex digest of every room's tiles and exits, in order
+    digest = hashlib.sha256()
+    for room in rooms:
+        digest.update(repr((room.width, room.height, room.get_exit_table())).encode('utf-8'))
+        digest.update(bytes(room.grid))
+    return digest.hexdigest()[:16]
+
+class RoomIndex(object):
+    """
+    # Buckets the prefab rooms by exits per direction once, so that finding the
+    # candidate rooms for a node is a dictionary lookup instead of a scan
+    # Buckets keep the order of the original room list
+    """
+    def __init__(self, rooms):
+        self.rooms = list(rooms)
+        self.by_num_exits = {}  # Number of exits, list of rooms
+        self.by_counts = {}  # Exits per direction, list of rooms
+        for room in self.rooms:
+            self.by_num_exits.setdefault(room.get_num_exits(), []).append(room)
+            self.by_counts.setdefault(room.get_exit_counts(), []).append(room)
+        self.corridor_moves = get_corridor_moves(self.get_rooms_with_num_exits(2))  # For tying loops
+        # Furthest any one corridor move carries the open exit, for find_chain's estimate
+        self.corridor_step = max([abs(move[5][0]) + abs(move[5][1]) for direc_moves in self.corridor_moves.values() for move in direc_moves] or [0])
+        # Room numbers and a digest of the whole library, for patterns that outlive this index
+        self.ids = {room: idx for idx, room in enumerate(self.rooms)}
+        self.digest = hash_rooms(self.rooms)
+
+    def get_rooms(self, counts):
+        return self.by_counts.get(counts, [])
+
+    def get_rooms_with_num_exits(self, num_exits):
+        return self.by_num_exits.get(num_exits, [])
+
+class LiveGrid(object):
+    """
+    # Tile grid of the whole dungeon, kept up to date as chunks are set and unset,
+    # so looking at the current dungeon never rebuilds it
+    # Covers a region of chunk space that grows (at least doubling) whenever
+    # a chunk lands outside of it, so any coordinates work
+    """
+    def __init__(self):
+        self.origin_x, self.origin_y = 0, 0  # Chunk space position of tile (0, 0)
+        self.c_width, self.c_height = 0, 0
+        self.tiles = TileGrid((0, 0))
+        self.cover = {}  # Chunk cell, list of (chunk, x, y) covering it -- last one is drawn
+        self.columns = {}  # Chunk space x, number of covered cells in that column
+        self.rows = {}  # Chunk space y, number of covered cells in that row
+
+    def grow(self, x1, y1, x2, y2):
+        # Makes sure chunk space rectangle [x1, x2) x [y1, y2) is covered
+        old_x1, old_y1 = self.origin_x, self.origin_y
+        old_x2, old_y2 = old_x1 + self.c_width, old_y1 + self.c_height
+        if self.c_width and x1 >= old_x1 and y1 >= old_y1 and x2 <= old_x2 and y2 <= old_y2:
+            return
+        if not self.c_width:
+            new_x1, new_y1, new_x2, new_y2 = x1, y1, x2, y2
+        else:
+            new_x1 = old_x1 if x1 >= old_x1 else min(x1, old_x1 - self.c_width)
+            new_y1 = old_y1 if y1 >= old_y1 else min(y1, old_y1 - self.c_height)
+            new_x2 = old_x2 if x2 <= old_x2 else max(x2, old_x2 + self.c_width)
+            new_y2 = old_y2 if y2 <= old_y2 else max(y2, old_y2 + self.c_height)
+        tiles = TileGrid(((new_x2 - new_x1) * C.CHUNK_SIZE, (new_y2 - new_y1) * C.CHUNK_SIZE))
+        tiles.subsume((old_x1 - new_x1) * C.CHUNK_SIZE, (old_y1 - new_y1) * C.CHUNK_SIZE, self.tiles)
+        self.tiles = tiles
+        self.origin_x, self.origin_y = new_x1, new_y1
+        self.c_width, self.c_height = new_x2 - new_x1, new_y2 - new_y1
+
+    def draw_cell(self, cx, cy, chunk, x, y):
+        # Copies the part of chunk (placed at x, y) that covers chunk cell cx, cy
+        size = C.CHUNK_SIZE
+        src = chunk.grid
+        src_width = chunk.width
+        src_x, src_y = (cx - x) * size, (cy - y) * size
+        dest = self.tiles.grid
+        dest_width = self.tiles.width
+        dest_x, dest_y = (cx - self.origin_x) * size, (cy - self.origin_y) * size
+        for row in range(size):
+            start = (src_y + row) * src_width + src_x
+            dest_start = (dest_y + row) * dest_width + dest_x
+            dest[dest_start:dest_start + size] = src[start:start + size]
+
+    def clear_cell(self, cx, cy):
+        size = C.CHUNK_SIZE
+        dest = self.tiles.grid
+        dest_width = self.tiles.width
+        dest_x, dest_y = (cx - self.origin_x) * size, (cy - self.origin_y) * size
+        blank = bytes(size)
+        for row in range(size):
+            dest_start = (dest_y + row) * dest_width + dest_x
+            dest[dest_start:dest_start + size] = blank
+
+    def add(self, x, y, chunk):
+        self.grow(x, y, x + chunk.c_width, y + chunk.c_height)
+        self.tiles.subsume((x - self.origin_x) * C.CHUNK_SIZE, (y - self.origin_y) * C.CHUNK_SIZE, chunk)
+        for cy in range(y, y + chunk.c_height):
+            for cx in range(x, x + chunk.c_width):
+                self.cover.setdefault((cx, cy), []).append((chunk, x, y))
+        for cx in range(x, x + chunk.c_width):
+            self.columns[cx] = self.columns.get(cx, 0) + chunk.c_height
+        for cy in range(y, y + chunk.c_height):
+            self.rows[cy] = self.rows.get(cy, 0) + chunk.c_width
+
+    def remove(self, x, y, chunk):
+        for cy in range(y, y + chunk.c_height):
+            for cx in range(x, x + chunk.c_width):
+                covering = self.cover[(cx, cy)]
+                on_top = covering[-1][0] is chunk
+                covering[:] = [c for c in covering if c[0] is not chunk]
+                if not covering:
+                    del self.cover[(cx, cy)]
+                    self.clear_cell(cx, cy)
+                elif on_top:
+                    self.draw_cell(cx, cy, *covering[-1])
+        for cx in range(x, x + chunk.c_width):
+            self.columns[cx] -= chunk.c_height
+            if not self.columns[cx]:
+                del self.columns[cx]
+        for cy in range(y, y + chunk.c_height):
+            self.rows[cy] -= chunk.c_width
+            if not self.rows[cy]:
+                del self.rows[cy]
+
+    def get_bounds(self):
+        # Chunk space bounds of everything currently placed
+        if not self.columns:
+            return 0, 0, 0, 0
+        return min(self.columns), min(self.rows), max(self.columns) + 1, max(self.rows) + 1
+
+    def crop(self):
+        # Copy of the tiles trimmed to exactly the placed chunks
+        min_x, min_y, max_x, max_y = self.get_bounds()
+        size = C.CHUNK_SIZE
+        grid = TileGrid(((max_x - min_x) * size, (max_y - min_y) * size))
+        src_x, src_y = (min_x - self.origin_x) * size, (min_y - self.origin_y) * size
+        for row in range(grid.height):
+            start = (src_y + row) * self.tiles.width + src_x
+            grid.grid[row*grid.width:(row + 1)*grid.width] = self.tiles.grid[start:start + grid.width]
+        return grid
@@ -1,8 +1,16 @@
 # User-defined constants
 
 DEBUG = True
-IM_DEBUG = True
+IM_DEBUG = True  # Records every placement to PROGRESS_LOG
 CHUNK_SIZE = 4
 DIRECTIONS = ('up', 'left', 'right', 'down')
+# Copies of every room image the library adds, besides the image itself:
+# any of 'flip_x', 'flip_y', 'rotate_90', 'rotate_180', 'rotate_270'
+SYMMETRIES = ('flip_x',)
 SEED = 1  # Set to None to use random seed
-LIMIT = 10000  # How many steps to try before giving up
+BACKJUMP = 'chronological'  # Or 'conflict' to jump back to whatever blocked the failed node
+SOLVER = False  # Place rooms with solver.py's constraint propagation instead of trial and error
+TIE_LOOP_LIMIT = 500  # Most states tie_loop looks at before giving up on a loop
+PATTERN_CACHE_SIZE = 1024  # Connection patterns kept by pattern_cache.py; 0 turns the cache off
+LIMIT = 10000  # Most in-progress images Dungeon.draw saves; see budget.py for limiting generation
+PROGRESS_LOG = 'progress.log'  # Render with progress_log.py
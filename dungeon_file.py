@@ -0,0 +1,188 @@
+import argparse, mmap, os, struct
+
+# === my imports ===
+import constants as C
+from chunk_objects import TileGrid, grid_to_image
+from budget import BUDGET_REASONS
+
+MAGIC = b'DGN1'
+VERSION = 1
+TILES = 1  # Header flag: the packed tiles are in the file
+# Magic, version, chunk size, flags, status, number of nodes, placements and connections,
+# tile width and height, room library digest
+HEADER = struct.Struct('<4sHHHHIIIII16s')
+# Room id in the library, x, y in chunk space, node id, flags (1 = piece of a tied loop), padding
+PLACEMENT = struct.Struct('<IiiIB3x')
+# Placement index, direction index, position along the edge, node id the exit leads to
+CONNECTION = struct.Struct('<IBxHI')
+# Room id, name length -- followed by the name
+ROOM = struct.Struct('<IH')
+NO_NODE = 0xFFFFFFFF  # Chunk with no owner left, or an exit leading out of a world region
+STATUSES = (None, 'success', 'failure') + BUDGET_REASONS
+
+# Tile codes fit in 4 bits, so tiles are packed two to a byte, first tile in the high half
+HIGH_TABLE = bytes((v & 15) << 4 for v in range(256))
+UNPACK_HIGH = bytes(v >> 4 for v in range(256))
+UNPACK_LOW = bytes(v & 15 for v in range(256))
+
+def pack_tiles(tiles):
+    if len(tiles) % 2:
+        tiles = tiles + b'\0'
+    high = bytes(tiles[0::2]).translate(HIGH_TABLE)
+    low = bytes(tiles[1::2])
+    # OR-ing as big integers packs every byte at once
+    return (int.from_bytes(high, 'big') | int.from_bytes(low, 'big')).to_bytes(len(high), 'big')
+
+def unpack_tiles(packed, num_tiles):
+    tiles = bytearray(len(packed)*2)
+    tiles[0::2] = packed.translate(UNPACK_HIGH)
+    tiles[1::2] = packed.translate(UNPACK_LOW)
+    del tiles[num_tiles:]
+    return tiles
+
+def write_dungeon(fp, dungeon, tiles=True):
+    """
+    # Binary dungeon: header, placements, connections, packed tiles (optional), then
+    # the names of the rooms used. Everything but the names is fixed size, so
+    # DungeonFile finds any record without reading what comes before it
+    # Node ids count from the dungeon's first node, which is the entrance
+    # A dungeon that ran out of budget is written as its best partial grid, with the
+    # owners and connections it had then; nodes no longer in that try are NO_NODE
+    """
+    room_index = dungeon.room_index
+    if dungeon.status in BUDGET_REASONS:
+        # Saved as it was, which may be from a try before the last restart
+        chunks, links, nodes = dungeon.best_chunks, dungeon.best_links, dungeon.best_nodes
+    else:
+        chunks = list(dungeon.chunk_grid.chunks.items())
+        links = [dungeon.get_links(chunk) for _, chunk in chunks]
+        nodes = dungeon.nodes
+    base_nid = min(node.nid for node in nodes) if nodes else 0
+    def get_nid(node):
+        return node.nid - base_nid if node in nodes else NO_NODE
+
+    placements = []
+    connections = []
+    used_rooms = {}
+    for idx, (((x, y), chunk), (owner, chunk_links)) in enumerate(zip(chunks, links)):
+        room_id = room_index.ids[chunk.template]
+        used_rooms[room_id] = chunk.name
+        placements.append(PLACEMENT.pack(room_id, x, y, get_nid(owner), 1 if chunk.is_subchunk else 0))
+        for direction, pos, to in chunk_links:
+            connections.append(CONNECTION.pack(idx, C.DIRECTIONS.index(direction), pos, get_nid(to)))
+
+    grid = dungeon.main_grid
+    width, height = (grid.width, grid.height) if grid and tiles else (0, 0)
+    flags = TILES if grid and tiles else 0
+    tmp_fp = '%s.%d.tmp' % (fp, os.getpid())
+    with open(tmp_fp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, C.CHUNK_SIZE, flags, STATUSES.index(dungeon.status), len(nodes),
+                            len(placements), len(connections), width, height, room_index.digest.encode('ascii')))
+        f.write(b''.join(placements))
+        f.write(b''.join(connections))
+        if flags & TILES:
+            f.write(pack_tiles(grid.grid))
+        for room_id, name in sorted(used_rooms.items()):
+            name = name.encode('utf-8')
+            f.write(ROOM.pack(room_id, len(name)))
+            f.write(name)
+    os.replace(tmp_fp, fp)
+
+class DungeonFile(object):
+    """
+    # Memory-mapped read access to a file written by write_dungeon
+    # Nothing is read until asked for, and records are unpacked straight out of
+    # the mapping, so opening a dungeon costs the same however big it is
+    # placement_buffer and connection_buffer are memoryviews over the raw
+    # records, for callers that want to hand them on without copying
+    # The mapping can't be closed while one is held, so release them first
+    # (or use them in a with block)
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        with open(fp, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, chunk_size, flags, status, num_nodes, num_placements, num_connections, width, height, digest = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            self.data.close()
+            raise ValueError('%s is not a dungeon file for this version' % fp)
+        self.chunk_size = chunk_size
+        self.status = STATUSES[status]
+        self.num_nodes = num_nodes
+        self.num_placements = num_placements
+        self.num_connections = num_connections
+        self.width = width
+        self.height = height
+        self.digest = digest.decode('ascii')  # Of the room library the room ids index into
+        self.has_tiles = bool(flags & TILES)
+        self.placement_offset = HEADER.size
+        self.connection_offset = self.placement_offset + num_placements*PLACEMENT.size
+        self.tile_offset = self.connection_offset + num_connections*CONNECTION.size
+        self.room_offset = self.tile_offset + ((width*height + 1)//2 if self.has_tiles else 0)
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def placement_buffer(self):
+        return memoryview(self.data)[self.placement_offset:self.connection_offset]
+
+    @property
+    def connection_buffer(self):
+        return memoryview(self.data)[self.connection_offset:self.tile_offset]
+
+    def get_placement(self, idx):
+        # (room id, x, y, node id, is a piece of a tied loop)
+        room_id, x, y, nid, flags = PLACEMENT.unpack_from(self.data, self.placement_offset + idx*PLACEMENT.size)
+        return room_id, x, y, nid, bool(flags & 1)
+
+    def get_placements(self):
+        return [self.get_placement(idx) for idx in range(self.num_placements)]
+
+    def get_connections(self):
+        # (placement index, direction, position along the edge, node id it leads to)
+        with self.connection_buffer as records:
+            return [(idx, C.DIRECTIONS[direction], pos, nid) for idx, direction, pos, nid in CONNECTION.iter_unpack(records)]
+
+    def get_room_names(self):
+        # Room id, name, for every room in the dungeon
+        names = {}
+        offset = self.room_offset
+        while offset < len(self.data):
+            room_id, length = ROOM.unpack_from(self.data, offset)
+            offset += ROOM.size
+            names[room_id] = self.data[offset:offset + length].decode('utf-8')
+            offset += length
+        return names
+
+    def get_code(self, x, y):
+        # Tile code at one tile, without unpacking the rest
+        idx = y*self.width + x
+        byte = self.data[self.tile_offset + idx//2]
+        return byte & 15 if idx % 2 else byte >> 4
+
+    def get_tiles(self):
+        if not self.has_tiles:
+            return None
+        grid = TileGrid((self.width, self.height))
+        grid.grid = unpack_tiles(self.data[self.tile_offset:self.room_offset], self.width*self.height)
+        return grid
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show a binary dungeon file, or draw its tiles')
+    parser.add_argument('file')
+    parser.add_argument('-o', '--output', default=None, help='Save the tiles as this image')
+    parser.add_argument('--scale', type=int, default=5)
+    args = parser.parse_args()
+    with DungeonFile(args.file) as dungeon:
+        print('Status: %s, Nodes: %d, Chunks: %d, Connections: %d, Tiles: %dx%d' % (
+              dungeon.status, dungeon.num_nodes, dungeon.num_placements, dungeon.num_connections, dungeon.width, dungeon.height))
+        if args.output and dungeon.has_tiles:
+            grid_to_image(dungeon.get_tiles(), args.scale).save(args.output)
+            print('Saved %s' % args.output)
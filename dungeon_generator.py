@@ -1,33 +1,73 @@
-import random, sys
+import heapq, random
 import glob, os
-from PIL import Image
 
 # === my imports ===
-from utilities import opposite, calculate_distance
+from utilities import opposite, calculate_distance, overlaps, derive_seed, run_steps, weighted_shuffle, weighted_choice
 import constants as C
-
-# Seed setting needs to be done before import for some reason...
-# Or else random seed does not take effect
-if C.SEED is not None:
-    print('Seed: %d' % C.SEED)
-    random.seed(C.SEED)
-
 from graph_objects import Node
-from chunk_objects import Room, Grid
+from chunk_objects import Grid, LiveGrid, RoomIndex, get_exit_point, grid_to_image, grid_to_text
+from room_library import load_rooms
+from progress_log import ProgressLog
+from solver import Solver
+from node_sources import load_layout
+from pattern_cache import PatternCache
+from metrics import Metrics, print_sink
+
+BACKJUMPS = ('chronological', 'conflict')
 
 class Dungeon():
-    def __init__(self, prefab_rooms):
+    def __init__(self, prefab_rooms, node_map='NodeMap.png', rng=None, build=True, metrics=None, backjump=C.BACKJUMP, solver=C.SOLVER, record=None, pattern_cache=None, budget=None):
         self.nodes = set()  # all nodes in the dungeon
         self.entrance_node = None
+        self.node_map = node_map  # Where the node graph comes from -- see build_node_graph
+        self.success = False
+        # 'success', 'failure', or the budget limit that ran out (see budget.py)
+        self.status = None
+        self.budget = budget
+        self.best_chunks = []  # Most chunks placed at once so far, as ((x, y), chunk), when there is a budget
+        self.best_links = []  # get_links of each of best_chunks when they were saved
+        self.best_nodes = set()  # Nodes of the try best_chunks came from
+        self.restarts = 0
+        # Every random choice for this dungeon comes from here, so the same seed gives the same dungeon
+        self.rng = rng if rng is not None else random.Random(C.SEED)
+        # Counters and events for this run; DEBUG prints the events if no metrics are given
+        if metrics is None:
+            metrics = Metrics(print_sink if C.DEBUG else None)
+        self.metrics = metrics
 
         self.prefab_rooms = prefab_rooms
-
-        self.chunk_grid = ChunkGrid(self, prefab_rooms)
+        self.room_index = RoomIndex(prefab_rooms)
+
+        # How far back to go when a node can't be placed -- see build_chunk_grid
+        if backjump not in BACKJUMPS:
+            raise ValueError('Unknown backjump policy %r, expected one of %s' % (backjump, ', '.join(BACKJUMPS)))
+        self.backjump = backjump
+        self.solver = solver  # Place rooms with constraint propagation instead
+        # Solved connection patterns; a fresh one unless shared, so a seed alone decides the dungeon
+        self.pattern_cache = pattern_cache if pattern_cache is not None else PatternCache()
         self.main_grid = None
         self.img_output_count = 0
+        self.progress_log = None
+        if record is None:
+            record = C.IM_DEBUG  # Looked up here, since batch workers turn it off at run time
+        if record is True:
+            self.progress_log = ProgressLog(C.PROGRESS_LOG)
+        elif record:  # Anything with ProgressLog's record_ methods and close, e.g. service.EventStream
+            self.progress_log = record
+        self.chunk_grid = self.new_chunk_grid()
         self.num_subnodes = 0
 
-        self.start()
+        # Otherwise the caller runs the steps of start themselves
+        if build:
+            self.start()
+
+    def new_chunk_grid(self):
+        chunk_grid = ChunkGrid(self, self.prefab_rooms, self.rng, self.metrics)
+        if self.backjump == 'conflict':
+            chunk_grid.conflicts = set()
+        chunk_grid.pattern_cache = self.pattern_cache
+        chunk_grid.progress_log = self.progress_log
+        return chunk_grid
 
     def add_node(self):
         new_node = Node()
@@ -35,40 +75,111 @@ class Dungeon():
         return new_node
 
     def start(self):
-        # Step 2
-        node_dict = self.build_node_graph('NodeMap.png')
-        if C.DEBUG: 
-            self.write_node_graph(node_dict)
-        # Step 3
-        output = self.build_chunk_grid()
+        run_steps(self.start_steps())
+
+    def start_steps(self, every=None):
+        """
+        # start as a generator, yielding every so many rounds of building the chunk grid,
+        # so the caller can do other work in between (see service.py)
+        """
+        budget = self.budget
+        if budget:
+            budget.start()
+        # Read once, since every restart builds the node graph again
+        layout = load_layout(self.node_map)
+        for attempt in range(budget.restarts + 1 if budget else 1):
+            if attempt:
+                self.restart(attempt)
+            # Step 2
+            node_dict = self.build_node_graph(layout)
+            if C.DEBUG:
+                self.write_node_graph(node_dict)
+            # Step 3
+            if budget:
+                budget.start_try(self.metrics.counters)
+            output = yield from self.build_steps(every)
+            if output or self.status == 'time':
+                break
+        if self.progress_log:
+            self.progress_log.close()
         if not output:
-            print('ERROR: Building chunk grid failed!')
+            if self.status == 'failure':
+                print('ERROR: Building chunk grid failed!')
+            else:  # check_budget already emitted out_of_budget
+                self.build_partial_grid()
             return
         # Step 4
         self.build_main_grid()
+        self.status = 'success'
+        self.success = True
+
+    def restart(self, attempt):
+        # Starts over with a fresh node graph and chunk grid, and a seed derived from where this one got to
+        if self.metrics.enabled:
+            self.metrics.emit('restart_dungeon', attempt=attempt, status=self.status)
+        self.record_progress()
+        for chunk in list(self.chunk_grid.chunks.values()):
+            self.chunk_grid.unset(chunk)  # So the progress log shows the grid emptying
+        self.rng.seed(derive_seed(self.rng.getrandbits(64), 'restart', attempt))
+        self.nodes = set()
+        self.entrance_node = None
+        self.chunk_grid = self.new_chunk_grid()
+        self.status = None
+        self.restarts = attempt
+
+    def check_budget(self):
+        # Stops the build if a limit ran out; returns whether it did
+        if not self.budget:
+            return False
+        reason = self.budget.check(self.metrics.counters)
+        if reason:
+            self.status = reason
+            if self.metrics.enabled:
+                self.metrics.emit('out_of_budget', reason=reason, chunks=len(self.chunk_grid.chunks))
+            return True
+        return False
+
+    def record_progress(self):
+        """
+        # Keeps the most chunks ever placed at once, to fall back on if the budget runs out
+        # Called just before chunks are taken away (a backtrack, a restart, or running out),
+        # so a copy is only made when a new most is about to be lost
+        """
+        if self.budget and len(self.chunk_grid.chunks) > len(self.best_chunks):
+            self.best_chunks = list(self.chunk_grid.chunks.items())
+            # Owners and connections too, since exits change, and a restart throws this try's nodes away
+            self.best_links = [self.get_links(chunk) for _, chunk in self.best_chunks]
+            self.best_nodes = self.nodes
+
+    def get_links(self, chunk):
+        # Node that owns chunk, and (direction, position, node it leads to) for every connected exit
+        # The node is None for an exit leading out of a world region
+        connections = []
+        for direction in C.DIRECTIONS:
+            for exit in chunk.exits[direction]:
+                if exit.edge:
+                    connections.append((direction, exit.pos, exit.edge.to if exit.edge is not True else None))
+        return self.chunk_grid.owners.get(chunk), connections
 
     # === BUILDING NODE GRAPH ================================================
-    def build_node_graph(self, fp):
-        def find_first_node(im):
-            width, height = im.size
-            # Find first black node
-            for x in range(width):
-                for y in range(height):
-                    color = im.getpixel((x, y))
-                    if color[:3] == (0, 0, 0):
-                        self.entrance_node = self.add_node()
-                        current_pos = x, y
-                        return current_pos
-
-        im = Image.open(fp)
-        current_pos = find_first_node(im)
-        
+    def build_node_graph(self, source):
+        """
+        # Nodes for a node graph source: a Layout, a .txt or .graph file, or a
+        # node map image -- see node_sources.load_layout
+        # Returns the Node for every key of the layout reachable from its entrance
+        """
+        layout = load_layout(source)
+        if layout.entrance is None:
+            raise ValueError('Node graph has no nodes')
+        current_pos = layout.entrance
+        self.entrance_node = self.add_node()
+
         frontier = [current_pos]
         node_dict = {current_pos: self.entrance_node}
         explored = set([current_pos])
         while frontier:
             c_pos = frontier.pop()
-            for direc, pos in self.get_adj_nodes(im, c_pos):
+            for direc, pos in layout.get_adj(c_pos):
                 if pos not in explored:
                     explored.add(pos)
                     new_node = self.add_node()
@@ -79,42 +190,41 @@ class Dungeon():
                     node_dict[c_pos].add_adj(direc, node_dict[pos])
         return node_dict
 
-    def get_adj_nodes(self, im, pos):
-        adj_nodes = []
-        true_pos = pos
-        for direc in ('up', 'left', 'right', 'down'):
-            pos = true_pos
-            dx, dy = 0, 0
-            if direc == 'up':
-                dy = -2
-            elif direc == 'left':
-                dx = -2
-            elif direc == 'right':
-                dx = 2
-            elif direc == 'down':
-                dy = 2
-            pos = pos[0] + dx, pos[1] + dy
-            if pos[0] < 0 or pos[1] < 0 or pos[0] >= im.size[0] or pos[1] >= im.size[1]:
-                continue
-            color = im.getpixel(pos)
-            if color[:3] == (0, 0, 0):
-                adj_nodes.append((direc, pos))
-        return adj_nodes
-
     # === BUILDING CHUNK GRID ================================================
     def build_chunk_grid(self):
+        return run_steps(self.build_steps())
+
+    def build_steps(self, every=None):
+        # Yields every so many rounds when every is given; returns whether every node was placed
+        if self.solver:
+            return (yield from Solver(self).solve_steps(every))
+        metrics = self.metrics
+        counters = metrics.counters
         frontier = [self.entrance_node]
         # Whether a node is chunked is essentially our explored set
         while(frontier):
-            print('== Round: %s -- %s %s' % (self.img_output_count, frontier, frontier[-1].adj.keys()))
-            if C.IM_DEBUG:
-                self.build_main_grid()
-                self.draw()
+            if self.check_budget():
+                self.record_progress()
+                return False
+            if metrics.enabled:
+                metrics.emit('round', round=counters.rounds, frontier=list(frontier), adj=list(frontier[-1].adj.keys()))
+            if self.progress_log:
+                self.progress_log.record_round()
+            counters.rounds += 1
+            if every and not counters.rounds % every:
+                yield
             current_node = frontier.pop()
             if current_node.chunk:
                 continue
+            # Left over from before a backjump; whoever gets placed next to it will add it again
+            if current_node is not self.entrance_node and not any(n.chunk for n in current_node.get_adj_nodes()):
+                continue
             # Keep trying until we've chosen a chunk for the node and placed it
-            success = self.chunk_grid.choose_room(current_node, self.prefab_rooms)
+            if metrics.enabled:
+                span = metrics.start_span()
+            success = self.chunk_grid.choose_room(current_node, self.room_index)
+            if metrics.enabled:
+                metrics.end_span('node', span, node=current_node, success=success)
             if success:
                 for node in current_node.get_adj_nodes():
                     if not node.chunk:
@@ -123,100 +233,108 @@ class Dungeon():
                         current_node.children.add(node)
             # Need to backtrack
             elif current_node.parent:
-                f_node = current_node.parent.unchunk(self.chunk_grid)
+                counters.backtracks += 1
+                culprit = self.find_culprit(current_node)
+                # Nodes jumped over keep their placed parents, so nothing else would add them back
+                stranded = [current_node] if culprit is not current_node.parent else []
+                self.record_progress()
+                f_node = culprit.unchunk(self.chunk_grid, stranded)
+                if metrics.enabled:
+                    metrics.emit('backtrack', node=current_node, to=f_node)
+                frontier.extend(stranded)
                 frontier.append(f_node)
             else:  # Total failure
-                print('=== Total Failure! ===')
+                if metrics.enabled:
+                    metrics.emit('total_failure', node=current_node)
+                self.status = 'failure'
                 return False
         return True
 
+    def find_culprit(self, node):
+        """
+        # Which node to unchunk when node could not be placed
+        # 'chronological' always goes back to the parent
+        # 'conflict' goes back to the most recently placed node that blocked node,
+        # either as a neighbour or by covering a spot one of its candidates needed,
+        # skipping over later nodes that had nothing to do with the failure
+        """
+        if self.backjump == 'conflict':
+            node.conflicts.update(n for n in node.get_adj_nodes() if n.chunk)
+            node.conflicts.update(self.chunk_grid.conflicts)
+            node.conflicts.discard(node)
+        culprit = node.get_backjump_target()
+        culprit.conflicts.update(node.conflicts)
+        culprit.conflicts.discard(culprit)
+        return culprit
+
     # === BUILDING FINAL ROOMS ===============================================
     def build_main_grid(self):
-        # Find the topleft of the chunk_grid
-        min_x, min_y, max_x, max_y = 100, 100, -100, -100
-        for chunk_pos, room in self.chunk_grid.chunks.items():
-            x, y = chunk_pos
-            if x < min_x:
-                min_x = x
-            if x + room.c_width > max_x:
-                max_x = x + room.c_width
-            if y < min_y:
-                min_y = y
-            if y + room.c_height > max_y:
-                max_y = y + room.c_height
-        width = max_x - min_x
-        height = max_y - min_y
-        self.main_grid = Grid((width * C.CHUNK_SIZE, height * C.CHUNK_SIZE))
-        for chunk_pos, room in self.chunk_grid.chunks.items():
-            offset_x = (chunk_pos[0] - min_x) * C.CHUNK_SIZE
-            offset_y = (chunk_pos[1] - min_y) * C.CHUNK_SIZE
-            self.main_grid.subsume(offset_x, offset_y, room)
+        # The chunk grid keeps the tiles up to date, so this only trims them
+        self.main_grid = self.chunk_grid.live_grid.crop()
+
+    def build_partial_grid(self):
+        # Main grid of the best partial chunk grid, after running out of budget
+        live_grid = LiveGrid()
+        for (x, y), chunk in self.best_chunks:
+            live_grid.add(x, y, chunk)
+        self.main_grid = live_grid.crop()
 
     def write_node_graph(self, node_dict):
+        # Only node maps and lattices have positions to draw nodes at
+        if not all(isinstance(k, tuple) for k in node_dict):
+            return
         min_x = min([k[0] for k in node_dict])
         min_y = min([k[1] for k in node_dict])
         new_grid = Grid((100, 100))
         for pos, node in node_dict.items():
             new_grid.set(pos[0] - min_x, pos[1] - min_y, node.nid)
+        rows = []
+        for y in range(new_grid.height):
+            row = [new_grid.get(x, y) for x in range(new_grid.width)]
+            rows.append(''.join('%02d' % tile if tile else '  ' for tile in row) + '\n')
         with open('node_grid_output.txt', 'w') as fp:
-            for y in range(new_grid.height):
-                for x in range(new_grid.width):
-                    tile = new_grid.get(x, y)
-                    if tile:
-                        fp.write('%02d' % tile)
-                    else:
-                        fp.write('  ')
-                fp.write('\n')
+            fp.write(''.join(rows))
 
     def write(self):
         if not self.main_grid:
             print('Error! Main Grid has not been initialized yet!')
             return False
         with open('grid_output.txt', 'w') as fp:
-            for y in range(self.main_grid.height):
-                for x in range(self.main_grid.width):
-                    tile = self.main_grid.get(x, y)
-                    if tile == 'Wall':
-                        fp.write('*')
-                    else:
-                        fp.write(' ')
-                fp.write('\n')
-
-    def draw(self, final=False):
+            fp.write(grid_to_text(self.main_grid))
+
+    def draw(self, final=False, scale=5):
         if not self.main_grid:
             print('Error! Main Grid has not been initialized yet!')
             return False
         if self.main_grid.width <= 0 or self.main_grid.height <= 0:
             return False
-        im = Image.new('RGB', (self.main_grid.width, self.main_grid.height))
-        for x in range(self.main_grid.width):
-            for y in range(self.main_grid.height):
-                tile = self.main_grid.get(x, y)
-                if tile == 'Wall':
-                    im.putpixel((x, y), (0, 0, 0))
-                elif tile == 'Exit':
-                    im.putpixel((x, y), (200, 0, 0))
-                elif tile == 'Empty':
-                    im.putpixel((x, y), (248, 248, 248))
-                else:
-                    im.putpixel((x, y), (200, 200, 200))
-        # Resize to show user output
+        # Scaled up to show user output
         if final:
             print('Saving final!')
-            im = im.resize((im.width * 5, im.height * 5), Image.NEAREST)
+            im = grid_to_image(self.main_grid, scale)
             im.save('grid_output_final.png')
         elif self.img_output_count < C.LIMIT:
-            im = im.resize((im.width * 5, im.height * 5), Image.NEAREST)
+            im = grid_to_image(self.main_grid, scale)
             im.save('Images/grid_output%04d.png' % self.img_output_count)
             self.img_output_count += 1
-        else:
-            sys.exit()
+        else:  # Enough images; generation carries on without them
+            return False
         im.close()
 
 class ChunkGrid():
-    def __init__(self, dungeon, prefab_rooms):
+    def __init__(self, dungeon, prefab_rooms, rng, metrics):
+        self.rng = rng
+        self.metrics = metrics
+        self.progress_log = None  # Records every set and unset when given
         self.chunks = {}
         self.chunk_positions = {}
+        self.occupied = {}  # Chunk cell, number of chunks covering that cell
+        self.live_grid = LiveGrid()  # Tiles of every chunk currently set
+        self.owners = {}  # Chunk, node it was placed for
+        self.num_assigned = 0  # Nodes given a chunk so far, to order placements
+        self.conflicts = None  # Nodes whose chunks blocked the current node, when backjumping needs them
+        self.bounds = None  # (x1, y1, x2, y2) every chunk has to fit inside, when set
+        self.pattern_cache = None  # Set by Dungeon
         self.dungeon = dungeon
         self.prefab_rooms = prefab_rooms
 
@@ -235,83 +353,71 @@ class ChunkGrid():
             y_pos = offset[1] + adj_chunk.c_height
         return x_pos, y_pos
 
-    def choose_room(self, node, legal_chunks):
-        true_legal_chunks = legal_chunks
-        legal_chunks = node.check_rooms(legal_chunks)  # Returns all chunks that fit node's parameters (num exits, direction of exits, anything else we want)
-        # print('Legal Chunks at start:')
-        # print(legal_chunks)
+    def choose_room(self, node, room_index):
+        self.metrics.counters.attempts += 1
+        if self.conflicts is not None:
+            self.conflicts.clear()
+        legal_chunks = node.check_rooms(room_index, self.metrics)  # Returns all chunks that fit node's parameters (num exits, direction of exits, anything else we want)
         if not legal_chunks:
-            print('Warning! No legal chunks!')
             return False
         chunked_adjs = [n for n in node.get_adj_nodes() if n.chunk]
         if chunked_adjs:
             for adj in chunked_adjs:
                 unchunked_directions = adj.get_unchunked_directions()
-                legal_chunks = [room for room in legal_chunks if any(room.exits[opposite(e)] for e in unchunked_directions)]
-                if not legal_chunks:
+                # Every legal chunk has the same exit counts as the node, so checking the node's edges checks them all
+                if not any(node.edges[opposite(e)] for e in unchunked_directions):
                     return False
             if len(chunked_adjs) == 1:
                 return self.find_one_exit(node, chunked_adjs[0], legal_chunks)
             elif len(chunked_adjs) == 2:
-                return self.tie_loop(node, chunked_adjs, true_legal_chunks)  # Uses true legal chunks since need access to every chunk type
+                # Only use chunks with two exits, since we're just tying off the loop
+                return self.tie_loop(node, chunked_adjs, room_index.corridor_moves)
             else:
                 return self.find_three_or_more(node, chunked_adjs, legal_chunks)
         else: # Entrance chunk
-            one_direction = list(node.get_unchunked_directions())[0]
+            unchunked_directions = node.get_unchunked_directions()
+            one_direction = [direc for direc in C.DIRECTIONS if direc in unchunked_directions][0]
             legal_chunks = [chunk for chunk in legal_chunks if chunk.exits[one_direction]]
-            chunk = random.choice(legal_chunks)
+            chunk = weighted_choice(self.rng, legal_chunks, [chunk.weight for chunk in legal_chunks])
             chosen_chunk = chunk.copy()
-            self.set(0, 0, chosen_chunk)
-            node.set_chunk(chosen_chunk)
+            self.place(node, 0, 0, chosen_chunk)
+            self.assign(node, chosen_chunk)
             return True
         return False
 
     def find_one_exit(self, node, adj_node, legal_chunks):
-        if C.DEBUG:
-            print('Finding one exit!')
         direction = adj_node.get_direction_to_node(node)
         adj_chunk = adj_node.chunk
-        if C.DEBUG:
-            print('Adj Node: %s, Direction: %s' % (adj_node, direction))
-            print('Adj Chunk Exits: %s' % [s for s in adj_chunk.exits.values() if s])
-        adj_exit = random.choice(tuple(adj_chunk.get_unchunked_exits(direction)))
+        if self.metrics.enabled:
+            self.metrics.emit('find_one_exit', node=node, adj=adj_node, direction=direction, candidates=len(legal_chunks))
+        adj_exit = self.rng.choice(tuple(adj_chunk.get_unchunked_exits(direction)))
 
-        random.shuffle(legal_chunks)
+        weighted_shuffle(self.rng, legal_chunks, [chunk.weight for chunk in legal_chunks])
         for chunk in legal_chunks:
-            exit = random.choice(tuple(chunk.exits[opposite(direction)]))
+            exit = self.rng.choice(tuple(chunk.exits[opposite(direction)]))
             x_pos, y_pos = self.find_new_position(direction, self.chunk_positions[adj_chunk], adj_chunk, adj_exit, chunk, exit)
             if self.collides(x_pos, y_pos, chunk):
+                self.metrics.counters.rejected += 1
                 continue
             chosen_chunk = chunk.copy()
-            self.set(x_pos, y_pos, chosen_chunk)
-            node.set_chunk(chosen_chunk)
+            self.place(node, x_pos, y_pos, chosen_chunk)
+            self.assign(node, chosen_chunk)
             chosen_exit = chosen_chunk.get_exit(exit.direction, exit.pos)
-            chosen_exit.edge = node.get_edge(adj_node)
-            adj_exit.edge = adj_node.get_edge(node)
+            self.connect(chosen_exit, node.get_edge(adj_node))
+            self.connect(adj_exit, adj_node.get_edge(node))
             return True
         return False
 
-    def tie_loop(self, node, chunked_adjs, legal_chunks):
-        def choose_chunk(chunk, real_pos, other_exit):
-            chunks.append(chunk.copy())
-            exits.append(other_exit)
-            positions.append(real_pos)
-            bad_rooms.append(set())
-
-        def calc_new_pos(chunk, cur_chunk, cur_exit, cur_pos):
-            first_exit = random.choice(chunk.get_unchunked_exits(opposite(cur_exit.direction)))
-            x_pos, y_pos = self.find_new_position(cur_exit.direction, cur_pos, cur_chunk, cur_exit, chunk, first_exit)
-            if self.collides(x_pos, y_pos, chunk):
-                return None
-            other_exit, other_direction = chunk.get_other_exit(first_exit)
-            other_exit_pos = self.get_xy_pos(chunk, other_direction, other_exit)
-            # real_pos, new_pos, other_exit
-            return chunk, (x_pos, y_pos), (x_pos + other_exit_pos[0], y_pos + other_exit_pos[1]), other_exit 
-
-        if C.DEBUG:
-            print('Tying Loop!')
-        # Only get nodes with two exits, since we're just tying off the loop
-        legal_chunks = [chunk for chunk in legal_chunks if chunk.get_num_exits() == 2]
+    def tie_loop(self, node, chunked_adjs, moves):
+        """
+        # Ties off a loop between two placed neighbours with a chain of two-exit rooms
+        # Tries the chains that tied the same loop shape before first, then searches with find_chain
+        # A piece can't collide with the grid or with an earlier piece of the same chain
+        # Gives up after TIE_LOOP_LIMIT states, so a loop that can't be tied fails quickly
+        """
+        metrics = self.metrics
+        if metrics.enabled:
+            metrics.emit('tie_loop', node=node, adjs=chunked_adjs)
         # Initial set-up
         a, b = chunked_adjs
         a_dir = a.get_direction_to_node(node)
@@ -325,155 +431,203 @@ class ChunkGrid():
         assert len(b_exit) == 1, "Node to tie to has more than one unchunked exit %s" % b_dir
         b_exit = b_exit[0]
 
-        # a_pos = self.chunk_positions[a.chunk]
+        a_pos = self.chunk_positions[a.chunk]
         b_pos = self.chunk_positions[b.chunk]
-        # a_exit_pos = self.get_xy_pos(a.chunk, a_dir, a_exit)
+        a_exit_pos = self.get_xy_pos(a.chunk, a_dir, a_exit)
         b_exit_pos = self.get_xy_pos(b.chunk, b_dir, b_exit)
-        # init_pos = a_pos[0] + a_exit_pos[0], a_pos[1] + a_exit_pos[1]
+        init_pos = a_pos[0] + a_exit_pos[0], a_pos[1] + a_exit_pos[1]
         final_pos = b_pos[0] + b_exit_pos[0], b_pos[1] + b_exit_pos[1]
-
-        chunks = [a.chunk]
-        exits = [a_exit]
-        positions = [self.chunk_positions[a.chunk]]
-        bad_rooms = [set()]
-
-        # Keep searching for 
-        loop_tied = False
-        while chunks and not loop_tied:
-            cur_chunk = chunks[-1]
-            cur_exit = exits[-1]
-            choose_from = [chunk for chunk in legal_chunks if chunk.get_unchunked_exits(opposite(cur_exit.direction)) and chunk.name not in bad_rooms[-1]]
-            random.shuffle(choose_from)
-
-            exit_pos = self.get_xy_pos(cur_chunk, cur_exit.direction, cur_exit)
-            cur_pos = positions[-1]
-            offset_x, offset_y = cur_pos[0] + exit_pos[0], cur_pos[1] + exit_pos[1]
-            distance_to_end = calculate_distance((offset_x, offset_y), final_pos)
-            if C.DEBUG:
-                print('Offset: %s %s' % (offset_x, offset_y))
-                print('Distance to end: %s' % distance_to_end)
-
-            # Get important position data for all chunks that fit in bounds
-            pos_data = []
-            for chunk in choose_from:
-                output = calc_new_pos(chunk, cur_chunk, cur_exit, cur_pos)
-                if output:
-                    pos_data.append(output)
-
-            # Check if any chunk ties the loop
-            for chunk, real_pos, new_pos, other_exit in pos_data:
-                if new_pos == final_pos and other_exit.direction == opposite(b_dir):
-                    if C.DEBUG:
-                        print('New Pos: %s, Final Pos: %s, Other Exit: %s, b_dir: %s' % (new_pos, final_pos, other_exit, b_dir))
-                    choose_chunk(chunk, real_pos, other_exit)
-                    loop_tied = True
-                    break
-            else:  # If we didn't break
-                # Since that failed, check if any chunk moves us closer to goal
-                for chunk, real_pos, new_pos, other_exit in pos_data:
-                    if C.DEBUG:
-                        print('New Pos: %s, Final Pos: %s' % (new_pos, final_pos))
-                    if calculate_distance(new_pos, final_pos) < distance_to_end:
-                        choose_chunk(chunk, real_pos, other_exit)
-                        break
-                else:  # Could not find any legal chunks -- need to backtrack
-                    bad_chunk = chunks.pop()
-                    if len(chunks) <= 0:
-                        return False  # Tying the loop did not work
-                    exits.pop()
-                    positions.pop()
-                    bad_rooms.pop()
-                    bad_rooms[-1].add(bad_chunk.name)
+        final_dir = opposite(b_dir)  # The last piece's other exit has to face b
+
+        # A chain that tied the same loop shape before, if it still fits here
+        key = ('loop', self.dungeon.room_index.digest, final_pos[0] - init_pos[0], final_pos[1] - init_pos[1], a_dir, final_dir)
+        pieces = None
+        for chain in self.pattern_cache.get(key) or ():
+            pieces = self.replay_chain(chain, init_pos, a_dir, moves)
+            if pieces:
+                metrics.counters.cache_hits += 1
+                break
+        if not pieces:
+            metrics.counters.cache_misses += 1
+            pieces = self.find_chain(init_pos, a_dir, final_pos, final_dir, moves)
+            if not pieces:
+                return False
+            self.pattern_cache.add_chain(key, tuple(move_idx for move_idx, _, _, _ in pieces))
 
         # ================== #
         # Done on completion #
-        print('Tied Loop Complete!')
-        for idx in range(1, len(chunks)):  # Skip first chunk since it is already chunked room
-            x_pos, y_pos = positions[idx]
-            chosen_chunk = chunks[idx]
+        chunks = []
+        for _, room, x_pos, y_pos in pieces:
+            chosen_chunk = room.copy()
             chosen_chunk.is_subchunk = True
-            self.set(x_pos, y_pos, chosen_chunk)
-            # chosen_chunk.mark_all_exits()
-        a_exit.edge = a.get_edge(node)  # To mark as connected
-        b_exit.edge = b.get_edge(node)
+            self.place(node, x_pos, y_pos, chosen_chunk)
+            chunks.append(chosen_chunk)
+        if metrics.enabled:
+            metrics.emit('tie_loop_done', node=node, pieces=len(chunks))
+        self.connect(a_exit, a.get_edge(node))  # To mark as connected
+        self.connect(b_exit, b.get_edge(node))
         final_chunk = chunks[-1]
-        node.set_chunk(final_chunk)
-        # Mark important exits
-        # final_chunk.get_unchunked_exits(opposite(a_dir))[0].edge = node.get_edge(a)
-        # final_chunk.get_unchunked_exits(opposite(b_dir))[0].edge = node.get_edge(b)
-        final_chunk.subchunks = chunks[1:-1]  # so that we still have a reference to them
+        self.assign(node, final_chunk)
+        final_chunk.subchunks = chunks[:-1]  # so that we still have a reference to them
         return True
 
+    def replay_chain(self, chain, pos, direc, moves):
+        # Pieces of a cached chain started from pos, or None if one of them collides
+        pieces = []
+        for move_idx in chain:
+            room, _, _, other_direction, offset, end = moves[direc][move_idx]
+            x_pos, y_pos = pos[0] + offset[0], pos[1] + offset[1]
+            if self.collides(x_pos, y_pos, room):
+                self.metrics.counters.rejected += 1
+                return None
+            pieces.append((move_idx, room, x_pos, y_pos))
+            pos, direc = (pos[0] + end[0], pos[1] + end[1]), other_direction
+        return pieces
+
+    def find_chain(self, init_pos, a_dir, final_pos, final_dir, moves):
+        """
+        # A* over (open exit, side it's on), stepping with the precomputed corridor moves
+        # Returns the pieces as (move index, room, x, y), or None
+        """
+        metrics = self.metrics
+        # No piece moves the open exit further than this, which keeps the estimate admissible
+        max_step = self.dungeon.room_index.corridor_step
+        if not max_step:
+            return None
+
+        def estimate(pos, direc):
+            # Fewest pieces that could still get from pos to the end; at least one unless we're there
+            if pos == final_pos and direc == final_dir:
+                return 0
+            return max(-(-calculate_distance(pos, final_pos) // max_step), 1)
+
+        # A state is (open exit, side it's on, pieces so far, piece rect, previous state, move index)
+        start = (init_pos, a_dir, 0, None, None, None)
+        heap = [(estimate(init_pos, a_dir), 0, 0, start)]
+        best = {(init_pos, a_dir): 0}  # Fewest pieces found to each open exit
+        num_pushed = 0
+        num_expanded = 0
+        found = None
+        while heap and num_expanded < C.TIE_LOOP_LIMIT:
+            state = heapq.heappop(heap)[3]
+            pos, direc, depth, _, _, _ = state
+            if depth and pos == final_pos and direc == final_dir:
+                found = state
+                break
+            num_expanded += 1
+            metrics.counters.loop_tie_steps += 1
+            if metrics.enabled:
+                metrics.emit('tie_loop_step', depth=depth, offset=pos, distance=calculate_distance(pos, final_pos))
+            for move_idx, move in enumerate(moves[direc]):
+                room, _, _, other_direction, offset, end = move
+                new_pos = pos[0] + end[0], pos[1] + end[1]
+                if best.get((new_pos, other_direction), depth + 2) <= depth + 1:
+                    continue
+                x_pos, y_pos = pos[0] + offset[0], pos[1] + offset[1]
+                if self.collides(x_pos, y_pos, room):
+                    metrics.counters.rejected += 1
+                    continue
+                rect = (x_pos, y_pos, room.c_width, room.c_height)
+                prev = state
+                while prev[3] and not overlaps(*(rect + prev[3])):
+                    prev = prev[4]
+                if prev[3]:  # Runs into its own chain
+                    metrics.counters.rejected += 1
+                    continue
+                best[(new_pos, other_direction)] = depth + 1
+                num_pushed += 1
+                # Random tie-breaks, so equally short chains aren't always built the same way
+                heapq.heappush(heap, (depth + 1 + estimate(new_pos, other_direction), self.rng.random(), num_pushed,
+                                      (new_pos, other_direction, depth + 1, rect, state, move_idx)))
+        if not found:
+            return None
+        pieces = []
+        while found[4]:
+            prev = found[4]
+            pieces.append((found[5], moves[prev[1]][found[5]][0]) + found[3][:2])
+            found = prev
+        pieces.reverse()
+        return pieces
+
     def find_three_or_more(self, node, chunked_adj_nodes, legal_chunks):
-        if C.DEBUG:
-            print('Finding Three or More!')
+        if self.metrics.enabled:
+            self.metrics.emit('find_three_or_more', node=node, adjs=chunked_adj_nodes, candidates=len(legal_chunks))
         # See if there is one chunk that fits all the requirements
         # Get the true exit positions and directions
         adj_exits = []
         for adj in chunked_adj_nodes:
             direction = adj.get_direction_to_node(node)
-            if C.DEBUG:
-                print(adj, direction)
-                print(adj.chunk.exits)
             exits = adj.chunk.get_unchunked_exits(direction)
             assert exits, "Adjacent chunk has no unchunked exits! That is impossible! (since we haven't been chunked yet and are adjacent)"
-            exit = random.choice(exits)
+            exit = self.rng.choice(exits)
             adj_exits.append((direction, adj, exit))
-        # print('Adjacent Exits')
-        # print(adj_exits)
         # Now we have all true exit positions
+        true_exits = []
+        for direc, adj, exit in adj_exits:
+            xy_pos = self.get_xy_pos(adj.chunk, direc, exit)
+            chunk_pos = self.chunk_positions[adj.chunk]
+            true_exits.append((chunk_pos[0] + xy_pos[0], chunk_pos[1] + xy_pos[1]))
+        # Which exits of a room line up with every other exit, once one of its exits is on the first,
+        # only depends on where the exits are relative to each other. So it is worked out for all
+        # legal rooms at once, without touching the chunk grid, and kept in the pattern cache
+        key = ('fit', self.dungeon.room_index.digest) + tuple((direc, x - true_exits[0][0], y - true_exits[0][1])
+                                                              for (direc, _, _), (x, y) in zip(adj_exits, true_exits))
+        aligned = self.pattern_cache.get_fits(key)  # (room id, first exit index), positions of the room's exits that line up
+        room_ids = self.dungeon.room_index.ids
+        others = [[(opposite(direc), x - fx, y - fy) for j, ((direc, _, _), (x, y)) in enumerate(zip(adj_exits, true_exits)) if j != i]
+                  for i, (fx, fy) in enumerate(true_exits)]
+        for chunk in legal_chunks:
+            room_id = room_ids[chunk]
+            if (room_id, 0) in aligned:
+                self.metrics.counters.cache_hits += 1
+                continue
+            points = chunk.exit_points
+            for first_idx, (fdir, _, _) in enumerate(adj_exits):
+                odir = opposite(fdir)
+                fit = tuple(exit.pos for exit in chunk.exits[odir] for px, py in [get_exit_point(chunk, odir, exit.pos)]
+                            if all((px + dx, py + dy) in points[direc] for direc, dx, dy in others[first_idx]))
+                self.pattern_cache.add_fit(aligned, (room_id, first_idx), fit)
         # We have to iterate through the legal chunks, finding any that can fit to the constraints
-        random.shuffle(legal_chunks)  # Shuffle so that we can just pick the first one we find
-        # print(legal_chunks)
+        # Exits are still drawn one candidate at a time, so the same seed picks the same room
+        weighted_shuffle(self.rng, legal_chunks, [chunk.weight for chunk in legal_chunks])  # Shuffle so that we can just pick the first one we find
         for chunk in legal_chunks:
+            room_id = room_ids[chunk]
             # Choose one of them to be first
-            for first_idx, _ in enumerate(adj_exits):
-                exit_match = {}
-                fdir, fadj, fexit = adj_exits[first_idx]
-                # Find offset
-                adj_pos = self.chunk_positions[fadj.chunk]
-                exit_pos = self.get_xy_pos(fadj.chunk, fdir, fexit)
-                offset_x, offset_y = adj_pos[0] + exit_pos[0], adj_pos[1] + exit_pos[1]
+            for first_idx, (fdir, fadj, fexit) in enumerate(adj_exits):
                 odir = opposite(fdir)
                 # choose the chunk's exit to match
-                chunk_exit = random.choice(tuple(chunk.exits[odir]))
-                exit_match[fadj] = fexit, chunk_exit
+                chunk_exit = self.rng.choice(tuple(chunk.exits[odir]))
+                if chunk_exit.pos not in aligned[(room_id, first_idx)]:
+                    self.metrics.counters.rejected += 1
+                    continue
+                # Find offset
+                offset_x, offset_y = true_exits[first_idx]
                 if odir == 'left' or odir == 'right':
                     offset_y -= chunk_exit.pos
                 else:
                     offset_x -= chunk_exit.pos
                 if self.collides(offset_x, offset_y, chunk):
+                    self.metrics.counters.rejected += 1
                     continue
 
-                # Now see if the rest fit
-                for i, values in enumerate(adj_exits):
-                    if first_idx == i:
-                        continue
-                    direc, adj, exit = values
-                    xy_pos = self.get_xy_pos(adj.chunk, direc, exit)
-                    chunk_pos = self.chunk_positions[adj.chunk]
-                    true_pos_x, true_pos_y = chunk_pos[0] + xy_pos[0], chunk_pos[1] + xy_pos[1]
-                    chunk_exit = chunk.confirm_match(offset_x, offset_y, true_pos_x, true_pos_y, opposite(direc))
-                    if chunk_exit:
-                        exit_match[adj] = exit, chunk_exit
-                    else:
-                        break
-                else:
-                    # Wow! Found them all!
-                    chosen_chunk = chunk.copy()
-                    self.set(offset_x, offset_y, chosen_chunk)
-                    node.set_chunk(chosen_chunk)
-                    for adj_node, values in exit_match.items():
-                        adj_exit, exit = values
-                        chosen_exit = chosen_chunk.get_exit(exit.direction, exit.pos)
-                        chosen_exit.edge = node.get_edge(adj_node)
-                        adj_exit.edge = adj_node.get_edge(node)
-                    return True
-
-        else:
-            if C.DEBUG:
-                print("*** Error! find_three_or_more didn't find any matching chunks!")
-            return False
+                # Found them all! Match up the rest
+                exit_match = {fadj: (fexit, chunk_exit)}
+                for i, (direc, adj, exit) in enumerate(adj_exits):
+                    if first_idx != i:
+                        exit_match[adj] = exit, chunk.confirm_match(offset_x, offset_y, true_exits[i][0], true_exits[i][1], opposite(direc))
+                chosen_chunk = chunk.copy()
+                self.place(node, offset_x, offset_y, chosen_chunk)
+                self.assign(node, chosen_chunk)
+                for adj_node, values in exit_match.items():
+                    adj_exit, exit = values
+                    chosen_exit = chosen_chunk.get_exit(exit.direction, exit.pos)
+                    self.connect(chosen_exit, node.get_edge(adj_node))
+                    self.connect(adj_exit, adj_node.get_edge(node))
+                return True
+
+        if self.metrics.enabled:
+            self.metrics.emit('no_match', node=node)
+        return False
 
     def get_xy_pos(self, chunk, direction, exit):
         if direction == 'up':
@@ -485,36 +639,79 @@ class ChunkGrid():
         elif direction == 'right':
             return (chunk.c_width, exit.pos)
 
+    # === Journalled changes ===
+    # Everything placing a node changes goes in some node's journal, so Node.undo can take it back
+    def place(self, node, x, y, chunk):
+        self.set(x, y, chunk)
+        self.owners[chunk] = node
+        node.journal.append(('chunk', chunk))
+
+    def assign(self, node, chunk):
+        self.num_assigned += 1
+        node.placed_at = self.num_assigned
+        node.set_chunk(chunk)
+
+    def connect(self, exit, edge):
+        # Goes in the journal of the node the exit leads to, since unchunking that node disconnects it
+        exit.edge = edge
+        edge.to.journal.append(('exit', exit))
+
     def set(self, x, y, chunk):
         self.chunks[(x, y)] = chunk
         self.chunk_positions[chunk] = (x, y)
+        self.metrics.counters.placements += 1
+        for cell in self.get_cells(x, y, chunk):
+            self.occupied[cell] = self.occupied.get(cell, 0) + 1
+        self.live_grid.add(x, y, chunk)
+        if self.progress_log:
+            self.progress_log.record_set(x, y, chunk)
 
     def unset(self, chunk):
         pos = self.chunk_positions[chunk]
         del self.chunks[pos]
         del self.chunk_positions[chunk]
+        self.owners.pop(chunk, None)
+        for cell in self.get_cells(pos[0], pos[1], chunk):
+            if self.occupied[cell] <= 1:
+                del self.occupied[cell]
+            else:
+                self.occupied[cell] -= 1
+        self.live_grid.remove(pos[0], pos[1], chunk)
+        if self.progress_log:
+            self.progress_log.record_unset(pos[0], pos[1], chunk)
+
+    def get_cells(self, x, y, chunk):
+        for cy in range(y, y + chunk.c_height):
+            for cx in range(x, x + chunk.c_width):
+                yield cx, cy
 
     def collides(self, x1, y1, chunk):
         """
         # Checks for collision in chunk space
-        # Currently very fast, but it does iterate through every single placed chunk
-        # May want to try a subgrid (one-layer octree) if this ends up being too slow
-        """ 
-        width1, height1 = chunk.c_width, chunk.c_height
-        for pos, chunk in self.chunks.items():
-            x2, y2 = pos
-            width2, height2 = chunk.c_width, chunk.c_height
-            if x1 < x2 + width2 and x1 + width1 > x2 and y1 < y2 + height2 and y1 + height1 > y2:
+        # Looks up each cell of the chunk's footprint in the occupancy index,
+        # so cost depends on the size of the chunk, not the number of placed chunks
+        # Anything reaching outside bounds collides too
+        """
+        bounds = self.bounds
+        if bounds and (x1 < bounds[0] or y1 < bounds[1] or x1 + chunk.c_width > bounds[2] or y1 + chunk.c_height > bounds[3]):
+            self.metrics.counters.collisions += 1
+            return True
+        occupied = self.occupied
+        for cell in self.get_cells(x1, y1, chunk):
+            if cell in occupied:
+                self.metrics.counters.collisions += 1
+                if self.conflicts is not None:
+                    self.conflicts.add(self.owners[self.live_grid.cover[cell][-1][0]])
                 return True
         return False
 
 if __name__ == '__main__':
     for im in glob.glob('Images/*.png'):
         os.remove(im)
-    images = glob.glob('Rooms/*.png')
-    rooms = [Room(Image.open(im), im) for im in images]
-    # Also flip the rooms horizontally, since left-right direction doesn't matter, and so we own't have to make mirrored rooms
-    rooms += [Room(Image.open(im).transpose(Image.FLIP_LEFT_RIGHT), im) for im in images]
+    # Rooms and their horizontal mirrors, from the compiled room library when it is up to date
+    rooms = load_rooms('Rooms/*.png')
     # Create dungeon
-    new_dungeon = Dungeon(rooms)
+    if C.SEED is not None:
+        print('Seed: %d' % C.SEED)
+    new_dungeon = Dungeon(rooms, rng=random.Random(C.SEED))
     new_dungeon.draw(True)
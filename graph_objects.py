@@ -30,6 +30,9 @@ class Node(object):
         self.parent = None  # From which node did we access this node
         self.children = set()  # What nodes follow this node in the graph
         self.num_times_unchunked = 0
+        self.journal = []  # ('chunk', chunk) and ('exit', exit) entries from placing this node
+        self.placed_at = 0  # When this node was last placed, for conflict-directed backjumping
+        self.conflicts = set()  # Placed nodes that have blocked this node since it was last reset
 
     def get_edge(self, node):
         return self.adj[node]
@@ -65,65 +68,96 @@ class Node(object):
     def get_direction_to_node(self, node):
         return self.adj[node].direction
 
-    def check_rooms(self, legal_chunks):
-        num_exits = len(self.get_adj_nodes())
-        legal_chunks = [room for room in legal_chunks if room.get_num_exits() == num_exits]
-        if C.DEBUG and not legal_chunks:
-            print('*** Error! No room with %d exits' % num_exits)
+    def get_exit_counts(self):
+        return tuple(len(self.edges[direc]) for direc in C.DIRECTIONS)
+
+    def check_rooms(self, room_index, metrics):
+        # Returns a fresh list, since callers shuffle it in place
+        legal_chunks = room_index.get_rooms(self.get_exit_counts())
+        if not legal_chunks:
+            if metrics.enabled:
+                num_exits = len(self.get_adj_nodes())
+                if not room_index.get_rooms_with_num_exits(num_exits):
+                    metrics.emit('no_legal_rooms', node=self, reason='No room with %d exits' % num_exits)
+                else:
+                    metrics.emit('no_legal_rooms', node=self, reason='No room with exits in right directions')
+            return []
+        if self.bad_chunks:
+            legal_chunks = [room for room in legal_chunks if room.name not in self.bad_chunks]
+            if metrics.enabled and not legal_chunks:
+                metrics.emit('no_legal_rooms', node=self, reason='Every legal room has been tried before')
             return legal_chunks
-        legal_chunks = [room for room in legal_chunks if all(len(room.exits[direc]) == len(self.edges[direc]) for direc in ('up', 'down', 'left', 'right'))]
-        if C.DEBUG and not legal_chunks:
-            print('*** Error! No room with exits in right directions!')
-            return legal_chunks
-        legal_chunks = [room for room in legal_chunks if room.name not in self.bad_chunks]
-        if C.DEBUG and not legal_chunks:
-            print("*** Warning! Only room that's legal has been tried before!")
-            return legal_chunks
-        return legal_chunks
+        return list(legal_chunks)
 
     def set_chunk(self, chunk):
-        if C.DEBUG:
-            print('Chunking: %s' % self)
         self.chunk = chunk
 
-    def unchunk(self, chunk_grid, child=False):
-        if C.DEBUG: 
-            if child:
-                print('Child Unchunking: %s' % self)
-            else:
-                print('Unchunking: %s' % self)
-        if self.chunk:
-            chunk_grid.unset(self.chunk)
-            if self.chunk.is_subchunk:
-                for chunk in self.chunk.subchunks:
-                    chunk_grid.unset(chunk)
-            else:
-                self.bad_chunks.add(self.chunk.name)  # make sure we don't choose that one again
-            # Also unchunk adjacent peoples exits to me
-            for adj_node in self.adj:
-                if C.DEBUG:
-                    print('Adj: %s' % adj_node)
-                if adj_node.chunk:
-                    for direction, exit_set in adj_node.chunk.exits.items():
-                        for exit in exit_set:
-                            if C.DEBUG: print('has Exit: %s' % exit)
-                            if exit.edge and exit.edge.to == self:
-                                exit.edge = None
-        for child_chunk in self.children:
-            child_chunk.unchunk(chunk_grid, child=True)
+    def undo(self, chunk_grid):
+        # Undoes this node's journal newest first, so the cost is what was done, not the size of the grid
+        while self.journal:
+            kind, item = self.journal.pop()
+            if kind == 'chunk':
+                chunk_grid.unset(item)
+            elif item.edge and item.edge.to is self:  # An exit that was connected to me
+                item.edge = None
         self.chunk = None
-        if child:
-            self.num_times_unchunked = 0
-            self.bad_chunks = set()
-            return self
-        elif self.parent and self.num_times_unchunked >= self.NUM_UNCHUNKS:
-            print('Backtracking!')
-            self.num_times_unchunked = 0  # reset
-            self.bad_chunks = set()
-            return self.parent.unchunk(chunk_grid)
-        else:
-            self.num_times_unchunked += 1
-            return self
+
+    def get_backjump_target(self):
+        # The most recently placed node that blocked this one, or the parent if none did
+        suspects = [node for node in self.conflicts if node.chunk]
+        if not suspects:
+            return self.parent
+        return max(suspects, key=lambda node: node.placed_at)
+
+    def reset(self):
+        self.num_times_unchunked = 0
+        self.bad_chunks = set()
+        self.conflicts = set()
+
+    def unchunk(self, chunk_grid, stranded=None):
+        """
+        # Unchunks this node and everything below it, and returns the node to try again
+        # Once this node has been unchunked NUM_UNCHUNKS times, goes back to its
+        # backjump target instead, which is the parent unless conflicts were recorded
+        # Nodes left unchunked while their parent stays placed are added to stranded
+        # Uses explicit stacks instead of recursion, so deep graphs can't hit the recursion limit
+        """
+        metrics = chunk_grid.metrics
+        node = self
+        while True:
+            metrics.counters.unchunks += 1
+            if metrics.enabled:
+                metrics.emit('unchunk', node=node, child=False)
+            if node.chunk and not node.chunk.is_subchunk:
+                node.bad_chunks.add(node.chunk.name)  # make sure we don't choose that one again
+            node.undo(chunk_grid)
+            stack = list(node.children)
+            seen = set([node])
+            while stack:
+                child = stack.pop()
+                if child in seen:
+                    continue
+                seen.add(child)
+                metrics.counters.unchunks += 1
+                if metrics.enabled:
+                    metrics.emit('unchunk', node=child, child=True)
+                child.undo(chunk_grid)
+                child.reset()
+                stack.extend(child.children)
+            if node.parent and node.num_times_unchunked >= self.NUM_UNCHUNKS:
+                target = node.get_backjump_target()
+                if metrics.enabled:
+                    metrics.emit('backtrack_to_parent', node=node, parent=target)
+                # The target is now to blame for whatever blocked this node
+                target.conflicts.update(node.conflicts)
+                target.conflicts.discard(target)
+                if target is not node.parent and stranded is not None:
+                    stranded.append(node)
+                node.reset()
+                node = target
+            else:
+                node.num_times_unchunked += 1
+                return node
 
     # def child_unchunk(self, chunk_grid):
     #     if C.DEBUG: print('Child Unchunking: %s' % self)
@@ -0,0 +1,74 @@
+import json, random, sys, time
+
+class Counters(object):
+    __slots__ = ('rounds',  # Frontier pops in build_chunk_grid
+                 'attempts',  # Calls to choose_room
+                 'placements',  # Chunks set in the chunk grid
+                 'collisions',  # Candidate positions that overlapped a placed chunk
+                 'rejected',  # Candidates that collided or did not line up with every adjacent exit
+                 'backtracks',  # Times build_chunk_grid had to unchunk a parent
+                 'unchunks',  # Nodes unchunked, including children
+                 'loop_tie_steps',  # Pieces tried while tying loops
+                 'cache_hits',  # Connection patterns that came from the pattern cache
+                 'cache_misses')  # Loops with no cached chain that fit, so they were searched for
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return ' '.join('%s=%d' % (name, getattr(self, name)) for name in self.__slots__)
+
+class Metrics(object):
+    """
+    # Counters for one generation run, plus events sent to a sink
+    # Counters are plain attributes and are always kept. Events are only built
+    # when there is a sink, so call sites check enabled first, and a run
+    # without a sink pays for that one check
+    """
+    def __init__(self, sink=None, sample_rate=1.0, seed=None):
+        self.counters = Counters()
+        self.sink = sink
+        self.enabled = sink is not None
+        self.sample_rate = sample_rate  # Share of events that reach the sink
+        # Separate from the dungeon's rng, so sampling never changes the dungeon
+        self.sampler = random.Random(seed)
+
+    def emit(self, name, **fields):
+        if self.sample_rate < 1.0 and self.sampler.random() >= self.sample_rate:
+            return
+        self.sink(name, fields)
+
+    def start_span(self):
+        return time.perf_counter()
+
+    def end_span(self, name, start, **fields):
+        fields['time'] = time.perf_counter() - start
+        self.emit(name, **fields)
+
+# === Sinks ===================================================================
+# A sink is any callable taking the event name and a dictionary of fields
+
+def print_sink(name, fields):
+    print('%s: %s' % (name, ' '.join('%s=%s' % (key, value) for key, value in sorted(fields.items()))))
+
+class JsonLinesSink(object):
+    # One JSON object per event, with the name under 'event'
+    def __init__(self, file=sys.stdout):
+        self.file = file
+
+    def __call__(self, name, fields):
+        record = {'event': name}
+        record.update(fields)
+        self.file.write(json.dumps(record, default=str) + '\n')
+
+class ListSink(object):
+    # Keeps (name, fields) pairs in memory, for tests and tools
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, name, fields):
+        self.events.append((name, fields))
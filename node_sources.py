@@ -0,0 +1,241 @@
+import re, struct
+from PIL import Image
+
+# === my imports ===
+import constants as C
+from utilities import opposite
+from chunk_objects import TILE_CODES, load_tile_grid
+
+# Magic, number of nodes, number of edges -- followed by the edges
+GRAPH_HEADER = struct.Struct('<4sII')
+GRAPH_MAGIC = b'NGR1'
+# Node index, node index, direction of the second from the first (index into C.DIRECTIONS)
+GRAPH_EDGE = struct.Struct('<IIB')
+POSITION = re.compile(r'^-?\d+,-?\d+$')  # Node name in a text layout that is a position
+
+class Layout(object):
+    """
+    # A node graph before it becomes Nodes: which nodes are next to which, and in which direction
+    # Keys can be anything hashable. Node maps use pixel positions, which
+    # World and write_node_graph need; text files use names
+    # Dungeon starts building from the entrance, which defaults to the first node added
+    """
+    def __init__(self, entrance=None):
+        self.adjacency = {}  # Key, list of (direction, key)
+        self.entrance = entrance
+
+    def add_node(self, key):
+        if key not in self.adjacency:
+            self.adjacency[key] = []
+            if self.entrance is None:
+                self.entrance = key
+
+    def add_edge(self, a, direction, b):
+        # b is in the given direction from a
+        self.add_node(a)
+        self.add_node(b)
+        self.adjacency[a].append((direction, b))
+        self.adjacency[b].append((opposite(direction), a))
+
+    def get_adj(self, key):
+        # In C.DIRECTIONS order, the order node maps have always been read in
+        return sorted(self.adjacency[key], key=lambda adj: C.DIRECTIONS.index(adj[0]))
+
+    def __len__(self):
+        return len(self.adjacency)
+
+def layout_from_positions(positions):
+    """
+    # Layout of node map pixels, where any two positions 2 apart are adjacent
+    # The entrance is the first position going column by column
+    """
+    layout = Layout(min(positions) if positions else None)
+    for pos in sorted(positions):
+        layout.add_node(pos)
+        right = pos[0] + 2, pos[1]
+        down = pos[0], pos[1] + 2
+        if right in positions:
+            layout.add_edge(pos, 'right', right)
+        if down in positions:
+            layout.add_edge(pos, 'down', down)
+    return layout
+
+# === Sources ===================================================================
+
+def read_node_map(fp):
+    # Layout of a node map image: black pixels are nodes
+    grid = load_tile_grid(Image.open(fp))
+    width = grid.width
+    # Searching the tile bytes finds every black pixel without a Python loop over the image
+    wall = re.escape(bytes([TILE_CODES['Wall']]))
+    positions = set((match.start() % width, match.start()//width) for match in re.finditer(wall, grid.grid))
+    return layout_from_positions(positions)
+
+def parse_key(word):
+    # 'x,y' names a position, anything else is just a name
+    if POSITION.match(word):
+        x, y = word.split(',')
+        return int(x), int(y)
+    return word
+
+def format_key(key):
+    if isinstance(key, tuple):
+        return '%d,%d' % key
+    return str(key)
+
+def read_text_layout(fp):
+    with open(fp) as f:
+        return parse_text_layout(f, fp)
+
+def parse_text_layout(lines, name='layout'):
+    """
+    # One edge per line, as 'a direction b', meaning b is in that direction from a
+    # A line with just a name adds a node with no edges. Blank lines and
+    # lines starting with # are skipped. The first node named is the entrance
+    # Names like 3,5 are read back as positions
+    """
+    layout = Layout()
+    for line_num, line in enumerate(lines, 1):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        if len(words) == 1:
+            layout.add_node(parse_key(words[0]))
+        elif len(words) == 3 and words[1] in C.DIRECTIONS:
+            layout.add_edge(parse_key(words[0]), words[1], parse_key(words[2]))
+        else:
+            raise ValueError('%s line %d: expected "a direction b", got %r' % (name, line_num, line.strip()))
+    return layout
+
+def write_text_layout(fp, layout):
+    with open(fp, 'w') as f:
+        for key, direction, other in get_edges(layout):
+            f.write('%s %s %s\n' % (format_key(key), direction, format_key(other)))
+        for key, adj in layout.adjacency.items():
+            if not adj:
+                f.write('%s\n' % format_key(key))
+
+def get_edges(layout):
+    # Every edge once, as (key, direction, key), starting from the entrance's
+    keys = get_keys(layout)
+    index = {key: idx for idx, key in enumerate(keys)}
+    for key in keys:
+        for direction, other in layout.get_adj(key):
+            if index[key] < index[other]:
+                yield key, direction, other
+
+def get_keys(layout):
+    # Entrance first, so it is node 0 in binary layouts
+    keys = [key for key in layout.adjacency if key != layout.entrance]
+    if layout.entrance is not None:
+        keys.insert(0, layout.entrance)
+    return keys
+
+def read_binary_layout(fp):
+    # Nodes are numbered from 0, which is the entrance
+    with open(fp, 'rb') as f:
+        data = f.read()
+    magic, num_nodes, num_edges = GRAPH_HEADER.unpack_from(data)
+    if magic != GRAPH_MAGIC:
+        raise ValueError('%s is not a node graph file' % fp)
+    layout = Layout()
+    for idx in range(num_nodes):
+        layout.add_node(idx)
+    for a, b, direction in GRAPH_EDGE.iter_unpack(data[GRAPH_HEADER.size:GRAPH_HEADER.size + num_edges*GRAPH_EDGE.size]):
+        layout.add_edge(a, C.DIRECTIONS[direction], b)
+    return layout
+
+def write_binary_layout(fp, layout):
+    keys = get_keys(layout)
+    index = {key: idx for idx, key in enumerate(keys)}
+    edges = [GRAPH_EDGE.pack(index[a], index[b], C.DIRECTIONS.index(direction)) for a, direction, b in get_edges(layout)]
+    with open(fp, 'wb') as f:
+        f.write(GRAPH_HEADER.pack(GRAPH_MAGIC, len(keys), len(edges)))
+        f.write(b''.join(edges))
+
+def load_layout(source):
+    """
+    # Layout from whatever Dungeon was given as its node map: a Layout, a .txt
+    # or .graph file, or a node map image (a file name or an open file)
+    """
+    if isinstance(source, Layout):
+        return source
+    if isinstance(source, str):
+        if source.endswith('.txt'):
+            return read_text_layout(source)
+        if source.endswith('.graph'):
+            return read_binary_layout(source)
+    return read_node_map(source)
+
+def get_region(key, span):
+    # Which square of span x span positions a position falls in
+    return key[0]//span, key[1]//span
+
+def split_layout(layout, span):
+    """
+    # Splits a node graph keyed by position into squares of span x span positions
+    # Returns {(rx, ry): Layout of the nodes in that square and the edges between them},
+    # and the edges that cross from one square into another, as (key, direction, key)
+    # Each square's entrance is its first position going column by column
+    """
+    if not all(isinstance(key, tuple) for key in layout.adjacency):
+        raise ValueError('Only node graphs keyed by position can be split into regions')
+    regions = {}
+    for key in sorted(layout.adjacency):
+        regions.setdefault(get_region(key, span), Layout()).add_node(key)
+    crossings = []
+    for a, direction, b in get_edges(layout):
+        region = get_region(a, span)
+        if region == get_region(b, span):
+            regions[region].add_edge(a, direction, b)
+        else:
+            crossings.append((a, direction, b))
+    return regions, crossings
+
+def get_reachable(layout):
+    # Keys Dungeon.build_node_graph would reach from the entrance
+    reachable = set([layout.entrance])
+    stack = [layout.entrance]
+    while stack:
+        for _, other in layout.adjacency[stack.pop()]:
+            if other not in reachable:
+                reachable.add(other)
+                stack.append(other)
+    return reachable
+
+# === Generators ================================================================
+
+def random_lattice(width, height, branching, extra_edges, rng):
+    """
+    # Layout of a random spanning tree over a width x height lattice,
+    # plus extra lattice edges to make loops
+    # Keys are the pixel positions make_node_map draws them at: lattice points
+    # are 4 pixels apart, with a node between every connected pair
+    # Branching is how often the tree grows from a random node instead of the newest one
+    # Every extra edge on top of the spanning tree closes one loop
+    """
+    start = (0, 0)
+    visited = set([start])
+    active = [start]
+    edges = set()
+    while active:
+        idx = rng.randrange(len(active)) if rng.random() < branching else len(active) - 1
+        x, y = active[idx]
+        neighbours = [(x + dx, y + dy) for dx, dy in ((0, -1), (-1, 0), (1, 0), (0, 1))
+                      if 0 <= x + dx < width and 0 <= y + dy < height and (x + dx, y + dy) not in visited]
+        if not neighbours:
+            active.pop(idx)
+            continue
+        nxt = rng.choice(neighbours)
+        visited.add(nxt)
+        active.append(nxt)
+        edges.add(((x, y), nxt) if (x, y) < nxt else (nxt, (x, y)))
+    all_edges = [((x, y), (x + 1, y)) for x in range(width - 1) for y in range(height)]
+    all_edges += [((x, y), (x, y + 1)) for x in range(width) for y in range(height - 1)]
+    unused = [edge for edge in all_edges if edge not in edges]
+    rng.shuffle(unused)
+    edges.update(unused[:int(len(unused) * extra_edges)])
+
+    positions = set((x * 4 + 1, y * 4 + 1) for x in range(width) for y in range(height))
+    positions.update((x1 * 2 + x2 * 2 + 1, y1 * 2 + y2 * 2 + 1) for (x1, y1), (x2, y2) in edges)
+    return layout_from_positions(positions)
@@ -0,0 +1,128 @@
+import collections, json, os
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: saves from several processes aren't locked against each other
+
+# === my imports ===
+import constants as C
+
+CHAINS_PER_LOOP = 4  # Corridor chains kept for each loop geometry
+
+def to_tuple(value):
+    # JSON gives back lists, at every level, for what were tuples
+    if isinstance(value, list):
+        return tuple(to_tuple(item) for item in value)
+    return value
+
+class PatternCache(object):
+    """
+    # Connection patterns that have been solved before, least recently used first
+    # Only the shape of a solution is kept, relative to the exits it joins and
+    # tied to one room library by its digest, so a pattern can be used again
+    # anywhere; collisions are still checked against the live ChunkGrid
+    # 'loop' entries are corridor chains tie_loop found, as indices into the corridor moves
+    # 'fit' entries are, for each (room, which exit goes first) in find_three_or_more,
+    # the room's exits that line up with all the other exits
+    # A replayed loop skips the random tie-breaks find_chain would have drawn, so the
+    # cache changes which dungeon a seed gives; a size of 0 turns it off
+    # With a file, patterns are read from it up front and written back by save,
+    # so runs can warm each other up. save merges in whatever other processes
+    # saved to the file since, so the patterns they learned aren't lost
+    """
+    def __init__(self, size=C.PATTERN_CACHE_SIZE, fp=None):
+        self.size = size
+        self.fp = fp
+        self.entries = collections.OrderedDict()  # Key, patterns
+        self.changed = False  # Since the last save
+        if fp and os.path.exists(fp):
+            self.load(fp)
+
+    def get(self, key):
+        patterns = self.entries.get(key)
+        if patterns is not None:
+            self.entries.move_to_end(key)
+        return patterns
+
+    def put(self, key, patterns):
+        self.add(key, patterns)
+        self.changed = True
+
+    def add(self, key, patterns):
+        # put without counting as a change
+        self.entries[key] = patterns
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def add_chain(self, key, chain):
+        chains = self.get(key) or []
+        self.put(key, [chain] + [c for c in chains if c != chain][:CHAINS_PER_LOOP - 1])
+
+    def get_fits(self, key):
+        # Fits are filled in with add_fit as candidates are tried, so the entry itself is handed out
+        fits = self.get(key)
+        if fits is None:
+            fits = {}
+            self.add(key, fits)
+        return fits
+
+    def add_fit(self, fits, candidate, fit):
+        fits[candidate] = fit
+        self.changed = True
+
+    def read(self, fp):
+        # Entries in a saved file, as (key, patterns)
+        with open(fp) as f:
+            data = json.load(f)
+        entries = []
+        for key, patterns in data:
+            key = to_tuple(key)
+            if key[0] == 'loop':
+                patterns = list(to_tuple(patterns))
+            else:
+                patterns = {to_tuple(candidate): to_tuple(fit) for candidate, fit in patterns}
+            entries.append((key, patterns))
+        return entries
+
+    def load(self, fp):
+        for key, patterns in self.read(fp):
+            self.add(key, patterns)
+        self.changed = False
+
+    def merge(self, fp):
+        # Adds what is saved in fp to what is in memory; entries only on disk count as least recently used
+        merged = collections.OrderedDict()
+        for key, patterns in self.read(fp):
+            mine = self.entries.get(key)
+            if mine is None:
+                merged[key] = patterns
+            elif key[0] == 'loop':
+                self.entries[key] = (mine + [chain for chain in patterns if chain not in mine])[:CHAINS_PER_LOOP]
+            else:
+                for candidate, fit in patterns.items():
+                    mine.setdefault(candidate, fit)
+        merged.update(self.entries)
+        self.entries = merged
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def save(self, fp=None):
+        # Written to a temporary file first, so a half-written cache is never read
+        # The lock file keeps another process from saving between the merge and the replace
+        fp = fp or self.fp
+        with open(fp + '.lock', 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(fp):
+                self.merge(fp)
+            data = []
+            for key, patterns in self.entries.items():
+                if key[0] == 'fit':
+                    patterns = list(patterns.items())
+                data.append((key, patterns))
+            tmp_fp = '%s.%d.tmp' % (fp, os.getpid())
+            with open(tmp_fp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_fp, fp)
+        self.changed = False
@@ -0,0 +1,146 @@
+import argparse, os, struct
+
+# === my imports ===
+import constants as C
+from chunk_objects import TileGrid, grid_to_image
+
+# Every record starts with an op byte
+ROOM, SET, UNSET, ROUND = 0, 1, 2, 3
+# Room id, name length, width, height -- followed by the name and the tiles
+ROOM_RECORD = struct.Struct('<IHHH')
+# Room id, x, y in chunk space
+CHUNK_RECORD = struct.Struct('<Iii')
+
+class ProgressLog(object):
+    """
+    # Append-only log of every chunk the ChunkGrid sets and unsets
+    # Each room template is written once, the first time it is placed,
+    # so the log can be replayed without the room library
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.file = open(fp, 'wb')
+        self.room_ids = {}  # Room template, id in this log
+
+    def get_room_id(self, chunk):
+        template = chunk.template
+        if template not in self.room_ids:
+            room_id = len(self.room_ids)
+            self.room_ids[template] = room_id
+            name = template.name.encode('utf-8')
+            self.file.write(bytes([ROOM]) + ROOM_RECORD.pack(room_id, len(name), template.width, template.height))
+            self.file.write(name)
+            self.file.write(bytes(template.grid))
+        return self.room_ids[template]
+
+    def record_set(self, x, y, chunk):
+        room_id = self.get_room_id(chunk)
+        self.file.write(bytes([SET]) + CHUNK_RECORD.pack(room_id, x, y))
+
+    def record_unset(self, x, y, chunk):
+        room_id = self.get_room_id(chunk)
+        self.file.write(bytes([UNSET]) + CHUNK_RECORD.pack(room_id, x, y))
+
+    def record_round(self):
+        self.file.write(bytes([ROUND]))
+
+    def close(self):
+        self.file.close()
+
+def read_progress_log(fp):
+    """
+    # Yields ('room', room_id, name, TileGrid), ('set', room_id, x, y),
+    # ('unset', room_id, x, y) and ('round',) in the order they were written
+    """
+    with open(fp, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        op = data[offset]
+        offset += 1
+        if op == ROOM:
+            room_id, name_length, width, height = ROOM_RECORD.unpack_from(data, offset)
+            offset += ROOM_RECORD.size
+            name = data[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            tiles = TileGrid((width, height))
+            tiles.grid = bytearray(data[offset:offset + width*height])
+            offset += width*height
+            yield 'room', room_id, name, tiles
+        elif op == SET or op == UNSET:
+            room_id, x, y = CHUNK_RECORD.unpack_from(data, offset)
+            offset += CHUNK_RECORD.size
+            yield 'set' if op == SET else 'unset', room_id, x, y
+        elif op == ROUND:
+            yield 'round',
+        else:
+            raise ValueError('Unknown record %d at byte %d of %s' % (op, offset - 1, fp))
+
+def get_bounds(fp):
+    # Chunk space bounds of everything that was ever placed, so every frame is the same size
+    rooms = {}
+    min_x, min_y, max_x, max_y = None, None, None, None
+    for record in read_progress_log(fp):
+        if record[0] == 'room':
+            rooms[record[1]] = record[3]
+        elif record[0] == 'set':
+            _, room_id, x, y = record
+            room = rooms[room_id]
+            right, bottom = x + room.width//C.CHUNK_SIZE, y + room.height//C.CHUNK_SIZE
+            min_x = x if min_x is None else min(min_x, x)
+            min_y = y if min_y is None else min(min_y, y)
+            max_x = right if max_x is None else max(max_x, right)
+            max_y = bottom if max_y is None else max(max_y, bottom)
+    return min_x, min_y, max_x, max_y
+
+def render_frames(fp, scale=5, limit=C.LIMIT):
+    # Yields one image per round, showing the chunks placed at the start of that round
+    min_x, min_y, max_x, max_y = get_bounds(fp)
+    if min_x is None:
+        return
+    size = ((max_x - min_x) * C.CHUNK_SIZE, (max_y - min_y) * C.CHUNK_SIZE)
+    rooms = {}
+    placed = {}  # Position, room id
+    num_frames = 0
+    for record in read_progress_log(fp):
+        if record[0] == 'room':
+            rooms[record[1]] = record[3]
+        elif record[0] == 'set':
+            placed[(record[2], record[3])] = record[1]
+        elif record[0] == 'unset':
+            placed.pop((record[2], record[3]), None)
+        elif record[0] == 'round':
+            if num_frames >= limit:
+                return
+            grid = TileGrid(size)
+            for pos, room_id in placed.items():
+                grid.subsume((pos[0] - min_x) * C.CHUNK_SIZE, (pos[1] - min_y) * C.CHUNK_SIZE, rooms[room_id])
+            yield grid_to_image(grid, scale)
+            num_frames += 1
+
+def render_progress_log(fp, out_dir=None, gif=None, scale=5, duration=50):
+    """
+    # Turns a progress log into numbered PNG frames in out_dir, a GIF, or both
+    """
+    frames = []
+    num_frames = 0
+    for im in render_frames(fp, scale):
+        if out_dir:
+            im.save(os.path.join(out_dir, 'grid_output%04d.png' % num_frames))
+        if gif:
+            frames.append(im)
+        num_frames += 1
+    if gif and frames:
+        frames[0].save(gif, save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    return num_frames
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a progress log written with IM_DEBUG on')
+    parser.add_argument('log', nargs='?', default=C.PROGRESS_LOG)
+    parser.add_argument('--frames', default=None, help='Directory to write PNG frames to')
+    parser.add_argument('--gif', default=None, help='GIF file to write')
+    parser.add_argument('--scale', type=int, default=5)
+    args = parser.parse_args()
+    if args.frames:
+        os.makedirs(args.frames, exist_ok=True)
+    print('Rendered %d frames' % render_progress_log(args.log, args.frames, args.gif, args.scale))
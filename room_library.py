@@ -0,0 +1,133 @@
+import glob, hashlib, os, struct
+from PIL import Image
+
+# === my imports ===
+import constants as C
+from chunk_objects import Room, TileGrid
+
+LIBRARY_FILE = 'rooms.lib'
+MAGIC = b'RLIB'
+VERSION = 2
+# Magic, version, chunk size, hash of the source images, number of rooms
+HEADER = struct.Struct('<4sHH32sI')
+# Name length, width, height, c_width, c_height, number of exits, weight
+ROOM_HEADER = struct.Struct('<HHHHHHH')
+# Direction index, position along the edge
+EXIT = struct.Struct('<BH')
+# What each name in C.SYMMETRIES does to a room image
+TRANSFORMS = {'flip_x': Image.FLIP_LEFT_RIGHT,
+              'flip_y': Image.FLIP_TOP_BOTTOM,
+              'rotate_90': Image.ROTATE_90,
+              'rotate_180': Image.ROTATE_180,
+              'rotate_270': Image.ROTATE_270}
+
+def hash_room_files(paths, symmetries=None):
+    """
+    # Hash of every source image's name and contents, so that the library
+    # is rebuilt whenever a room is added, removed or edited, or the symmetries change
+    # symmetries defaults to C.SYMMETRIES
+    """
+    if symmetries is None:
+        symmetries = C.SYMMETRIES
+    digest = hashlib.sha256()
+    digest.update(struct.pack('<HH', VERSION, C.CHUNK_SIZE))
+    digest.update(','.join(symmetries).encode('utf-8') + b'\0')
+    for path in sorted(paths):
+        digest.update(path.encode('utf-8') + b'\0')
+        with open(path, 'rb') as fp:
+            digest.update(hashlib.sha256(fp.read()).digest())
+    return digest.digest()
+
+def build_rooms(paths, symmetries=None):
+    """
+    # Every image, then every image flipped or rotated by each of symmetries
+    # (C.SYMMETRIES by default) in turn, so we won't have to draw mirrored or turned rooms
+    # A variant with the same tiles as an earlier room (a symmetric room's mirror,
+    # or a copy of another image) is dropped and adds its weight to that room instead,
+    # so it is picked as often as before without being tried twice
+    # Variants are named after their image and symmetry, e.g. Rooms/Loop.png@rotate_90
+    """
+    if symmetries is None:
+        symmetries = C.SYMMETRIES
+    paths = sorted(paths)
+    images = [Image.open(path) for path in paths]
+    rooms = []
+    seen = {}  # Width, height, tiles, room
+    for symmetry in (None,) + tuple(symmetries):
+        for im, path in zip(images, paths):
+            if symmetry is None:
+                room = Room(im, path)
+            else:
+                room = Room(im.transpose(TRANSFORMS[symmetry]), '%s@%s' % (path, symmetry))
+            key = (room.width, room.height, bytes(room.grid))
+            if key in seen:
+                seen[key].weight += 1
+            else:
+                seen[key] = room
+                rooms.append(room)
+    return rooms
+
+def write_library(fp, digest, rooms):
+    # Written to a temporary file first so readers never see a partial library
+    tmp_fp = '%s.%d.tmp' % (fp, os.getpid())
+    with open(tmp_fp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, C.CHUNK_SIZE, digest, len(rooms)))
+        for room in rooms:
+            name = room.name.encode('utf-8')
+            exit_table = room.get_exit_table()
+            f.write(ROOM_HEADER.pack(len(name), room.width, room.height, room.c_width, room.c_height, len(exit_table), room.weight))
+            f.write(name)
+            for direction, pos in exit_table:
+                f.write(EXIT.pack(C.DIRECTIONS.index(direction), pos))
+            f.write(bytes(room.grid))
+    os.replace(tmp_fp, fp)
+
+def read_library_digest(fp):
+    # Returns None if the file is missing or is not a library for this version
+    if not os.path.exists(fp):
+        return None
+    with open(fp, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    magic, version, chunk_size, digest, _ = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or chunk_size != C.CHUNK_SIZE:
+        return None
+    return digest
+
+def read_library(fp):
+    # The whole library is read at once; rooms share no data with the buffer
+    with open(fp, 'rb') as f:
+        data = f.read()
+    _, _, _, digest, num_rooms = HEADER.unpack_from(data, 0)
+    offset = HEADER.size
+    rooms = []
+    for _ in range(num_rooms):
+        name_length, width, height, _, _, num_exits, weight = ROOM_HEADER.unpack_from(data, offset)
+        offset += ROOM_HEADER.size
+        name = data[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+        exit_table = []
+        for _ in range(num_exits):
+            direction, pos = EXIT.unpack_from(data, offset)
+            offset += EXIT.size
+            exit_table.append((C.DIRECTIONS[direction], pos))
+        tiles = TileGrid((width, height))
+        tiles.grid = bytearray(data[offset:offset + width*height])
+        offset += width*height
+        rooms.append(Room(None, name, tiles, exit_table, weight))
+    return digest, rooms
+
+def load_rooms(pattern='Rooms/*.png', fp=LIBRARY_FILE, symmetries=None):
+    """
+    # Returns the rooms (and their variants, see build_rooms) for every image matching pattern
+    # Uses the compiled library at fp if it was built from the same images and symmetries,
+    # otherwise builds the rooms from the images and rewrites the library
+    """
+    paths = glob.glob(pattern)
+    digest = hash_room_files(paths, symmetries)
+    if read_library_digest(fp) == digest:
+        return read_library(fp)[1]
+    rooms = build_rooms(paths, symmetries)
+    write_library(fp, digest, rooms)
+    return rooms
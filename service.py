@@ -0,0 +1,186 @@
+import argparse, asyncio, base64, glob, json, random
+from concurrent.futures import ProcessPoolExecutor
+
+# === my imports ===
+import constants as C
+import batch
+from dungeon_generator import Dungeon
+from room_library import load_rooms, LIBRARY_FILE
+from node_sources import load_layout, parse_text_layout
+from budget import Budget
+
+YIELD_EVERY = 50  # Rounds of building between turns for the rest of the event loop
+HOST = '127.0.0.1'
+PORT = 8765
+BUDGET_FIELDS = ('time', 'attempts', 'backtracks', 'restarts')
+
+class EventStream(object):
+    """
+    # Placement events of one dungeon as an async stream of ('set' or 'unset', x, y, room name)
+    # The dungeon records into it the same way it would into a ProgressLog;
+    # read it with async for, which stops once the dungeon is done
+    # Events are queued until read, so a stream nobody reads only grows
+    """
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    def record_set(self, x, y, chunk):
+        self.queue.put_nowait(('set', x, y, chunk.name))
+
+    def record_unset(self, x, y, chunk):
+        self.queue.put_nowait(('unset', x, y, chunk.name))
+
+    def record_round(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+async def generate(prefab_rooms, node_map, seed, every=YIELD_EVERY, events=None, **kwargs):
+    """
+    # Builds a dungeon as a cooperative task, giving the event loop a turn every so many rounds
+    # Cancelling the task stops generation at its next turn
+    # Other keyword arguments go to Dungeon, e.g. budget or solver
+    """
+    dungeon = Dungeon(prefab_rooms, node_map, random.Random(seed), build=False, record=events or False, **kwargs)
+    try:
+        for _ in dungeon.start_steps(every):
+            await asyncio.sleep(0)
+    finally:
+        if events:
+            events.close()
+    return dungeon
+
+def make_pool(processes=None, room_pattern='Rooms/*.png', library_file=LIBRARY_FILE):
+    # Process pool for generate_in_pool, with the room library loaded once per process
+    load_rooms(room_pattern, library_file)
+    return ProcessPoolExecutor(processes, initializer=batch.init_worker, initargs=(room_pattern, library_file))
+
+async def generate_in_pool(pool, node_map, seed, budget=None):
+    """
+    # Builds a dungeon in one of pool's processes and returns its BatchResult
+    # Nothing runs on the event loop, but there are no events, and cancelling only
+    # stops a dungeon that hasn't started yet -- give it a budget to bound it
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, batch.generate_one, (load_layout(node_map), seed, budget, None))
+
+def result_to_dict(result):
+    return {'seed': result.seed,
+            'status': result.status,
+            'success': result.success,
+            'width': result.width,
+            'height': result.height,
+            'tiles': base64.b64encode(result.tiles).decode('ascii') if result.tiles else None,
+            'placements': result.placements}
+
+class Server(object):
+    """
+    # Generation jobs over a local socket, one JSON object per line each way
+    # A job is {"seed": 1, "node_map": "NodeMap.png"} or {"seed": 1, "graph": "<text layout>"},
+    # optionally with "time", "attempts", "backtracks" and "restarts" (see budget.py),
+    # "solver": true, and "progress": true for an {"event": ..., "x", "y", "room"} line per placement
+    # The answer is the job's BatchResult, with the tiles in base64, or {"error": ...}
+    # Only node maps the server was started with can be asked for by name
+    # Jobs run as cooperative tasks, or in a process pool when there is one (without progress)
+    """
+    def __init__(self, prefab_rooms, node_maps, pool=None, every=YIELD_EVERY):
+        self.prefab_rooms = prefab_rooms
+        self.layouts = {fp: load_layout(fp) for fp in node_maps}  # Read once for every job
+        self.pool = pool
+        self.every = every
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    job = json.loads(line)
+                    if not isinstance(job, dict):
+                        raise TypeError('A job must be a JSON object')
+                    await self.run_job(job, writer)
+                except ConnectionError:
+                    raise
+                except Exception as e:  # Whatever goes wrong with one job is its answer, and the connection stays open
+                    self.send(writer, {'error': str(e) or type(e).__name__})
+                await writer.drain()
+        except ConnectionError:
+            pass  # Client went away; run_job already cancelled its dungeon
+        finally:
+            writer.close()
+
+    def send(self, writer, message):
+        writer.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    def get_layout(self, job):
+        if 'graph' in job:
+            return parse_text_layout(job['graph'].splitlines(), 'graph')
+        node_map = job.get('node_map', 'NodeMap.png')
+        if node_map not in self.layouts:
+            raise KeyError('Unknown node map %r' % node_map)
+        return self.layouts[node_map]
+
+    def get_budget(self, job):
+        # Checked here, so a bad field is an error before the job starts rather than inside it
+        if not any(key in job for key in BUDGET_FIELDS):
+            return None
+        for key in BUDGET_FIELDS:
+            value = job.get(key)
+            number_types = int if key == 'restarts' else (int, float)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, number_types) or value < 0):
+                raise TypeError('%s must be a non-negative %s' % (key, 'integer' if key == 'restarts' else 'number'))
+        return Budget(job.get('time'), job.get('attempts'), job.get('backtracks'), job.get('restarts') or 0)
+
+    async def run_job(self, job, writer):
+        layout = self.get_layout(job)
+        seed = int(job['seed'])
+        budget = self.get_budget(job)
+        if self.pool:
+            result = await generate_in_pool(self.pool, layout, seed, budget)
+        else:
+            events = EventStream() if job.get('progress') else None
+            task = asyncio.ensure_future(generate(self.prefab_rooms, layout, seed, self.every, events,
+                                                  budget=budget, solver=bool(job.get('solver'))))
+            try:
+                if events:
+                    async for kind, x, y, name in events:
+                        self.send(writer, {'event': kind, 'x': x, 'y': y, 'room': name})
+                        await writer.drain()
+                dungeon = await task
+            finally:
+                task.cancel()  # Does nothing once it's done
+            result = batch.make_result(seed, dungeon)
+        self.send(writer, result_to_dict(result))
+
+async def serve(server, host=HOST, port=PORT):
+    listener = await asyncio.start_server(server.handle, host, port)
+    print('Serving on %s:%d' % (host, port))
+    async with listener:
+        await listener.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve dungeon generation jobs on a local socket')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('-m', '--node-maps', default='NodeMap*.png', help='Node maps jobs can ask for by name')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='Run jobs in a pool of this many processes')
+    args = parser.parse_args()
+    C.DEBUG = False
+    C.IM_DEBUG = False
+    pool = make_pool(args.processes) if args.processes else None
+    server = Server(load_rooms('Rooms/*.png'), glob.glob(args.node_maps), pool)
+    asyncio.run(serve(server, args.host, args.port))
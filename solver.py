@@ -0,0 +1,247 @@
+# === my imports ===
+from utilities import opposite, overlaps, run_steps, weighted_shuffle
+
+MISSING = object()  # Trail marker for a node that had no domain before
+FIRST_RESTART = 100  # Dead ends before the first restart; doubles after every restart
+
+class Solver(object):
+    """
+    # Places rooms by constraint propagation instead of trial and error
+    # Every unplaced node next to a placed one keeps a domain: the (room, x, y)
+    # placements that line up with all of its placed neighbours' free exits and
+    # don't collide with anything. Placing a room prunes the domains it touches
+    # (forward checking), so a node left with no values is a dead end found
+    # before going any deeper, and the next node is always the one with the
+    # fewest values left (minimum remaining values)
+    # Each domain also keeps the placed nodes that narrowed it, so a dead end
+    # jumps straight back to the latest of those instead of undoing unrelated work
+    # Nodes with two placed neighbours close a loop with ChunkGrid.tie_loop,
+    # which can't be listed up front, so they go first and get one try
+    # A search stuck in one corner of the map starts over, with a fresh shuffle
+    # and twice as many dead ends allowed each time, until the dungeon's budget runs out
+    """
+    def __init__(self, dungeon):
+        self.dungeon = dungeon
+        self.chunk_grid = dungeon.chunk_grid
+        self.room_index = dungeon.room_index
+        self.rng = dungeon.rng
+        self.metrics = dungeon.metrics
+        # Unplaced node next to a placed one, (values, placed nodes that narrowed them)
+        # Values are None for a loop to tie
+        self.domains = {}
+        if self.chunk_grid.conflicts is None:
+            self.chunk_grid.conflicts = set()
+
+    def get_domain(self, node):
+        # Values are (room, x, y, matches), where matches are (adj node, adj exit, room exit)
+        chunk_grid = self.chunk_grid
+        chunked_adjs = [n for n in node.get_adj_nodes() if n.chunk]
+        reasons = set(chunked_adjs)
+        if len(chunked_adjs) == 2:
+            # tie_loop needs exactly one free exit on each side to tie to
+            if all(len(adj.chunk.get_unchunked_exits(adj.get_direction_to_node(node))) == 1 for adj in chunked_adjs):
+                return None, reasons
+            return [], reasons
+        legal_chunks = node.check_rooms(self.room_index, self.metrics)
+        if not chunked_adjs:  # Entrance chunk
+            return [(room, 0, 0, ()) for room in legal_chunks], reasons
+        # Whoever took the neighbours' other exits also narrowed this domain
+        for adj in chunked_adjs:
+            for exits in adj.chunk.exits.values():
+                reasons.update(exit.edge.to for exit in exits if exit.edge)
+        first, rest = chunked_adjs[0], chunked_adjs[1:]
+        direction = first.get_direction_to_node(node)
+        adj_pos = chunk_grid.chunk_positions[first.chunk]
+        # Where the free exits of the other placed neighbours are, in chunk space
+        others = []
+        for adj in rest:
+            direc = adj.get_direction_to_node(node)
+            chunk_pos = chunk_grid.chunk_positions[adj.chunk]
+            true_exits = []
+            for exit in adj.chunk.get_unchunked_exits(direc):
+                xy_pos = chunk_grid.get_xy_pos(adj.chunk, direc, exit)
+                true_exits.append((exit, chunk_pos[0] + xy_pos[0], chunk_pos[1] + xy_pos[1]))
+            others.append((adj, opposite(direc), true_exits))
+
+        values = []
+        chunk_grid.conflicts.clear()
+        for adj_exit in first.chunk.get_unchunked_exits(direction):
+            for room in legal_chunks:
+                for exit in room.exits[opposite(direction)]:
+                    x_pos, y_pos = chunk_grid.find_new_position(direction, adj_pos, first.chunk, adj_exit, room, exit)
+                    if chunk_grid.collides(x_pos, y_pos, room):
+                        continue
+                    matches = [(first, adj_exit, exit)]
+                    for adj, odir, true_exits in others:
+                        for other_exit, true_x, true_y in true_exits:
+                            room_exit = room.confirm_match(x_pos, y_pos, true_x, true_y, odir)
+                            if room_exit:
+                                matches.append((adj, other_exit, room_exit))
+                                break
+                        else:
+                            break
+                    else:
+                        values.append((room, x_pos, y_pos, matches))
+        reasons.update(chunk_grid.conflicts)
+        return values, reasons
+
+    def choose_node(self):
+        # Minimum remaining values, with loops to tie first
+        def remaining(node):
+            values = self.domains[node][0]
+            return -1 if values is None else len(values)
+        return min(self.domains, key=remaining)
+
+    def place(self, node, value):
+        chunk_grid = self.chunk_grid
+        if value is None:
+            chunked_adjs = [n for n in node.get_adj_nodes() if n.chunk]
+            chunk_grid.conflicts.clear()
+            return chunk_grid.tie_loop(node, chunked_adjs, self.room_index.corridor_moves)
+        room, x_pos, y_pos, matches = value
+        chosen_chunk = room.copy()
+        chunk_grid.place(node, x_pos, y_pos, chosen_chunk)
+        chunk_grid.assign(node, chosen_chunk)
+        for adj_node, adj_exit, exit in matches:
+            chunk_grid.connect(chosen_chunk.get_exit(exit.direction, exit.pos), node.get_edge(adj_node))
+            chunk_grid.connect(adj_exit, adj_node.get_edge(node))
+        return True
+
+    def propagate(self, node):
+        """
+        # Forward checking after node was placed
+        # Returns the trail of domains it replaced, and the nodes whose domains emptied
+        """
+        domains = self.domains
+        trail = {node: domains.pop(node)}
+        # New constraints for node's neighbours, and fewer free exits for its placed neighbours' neighbours
+        affected = {}  # Used as an ordered set, so the same seed visits nodes in the same order
+        for adj in node.get_adj_nodes():
+            if not adj.chunk:
+                affected[adj] = True
+            else:
+                affected.update((n, True) for n in adj.get_adj_nodes() if not n.chunk)
+        wiped_out = []
+        for other in affected:
+            trail[other] = domains.get(other, MISSING)
+            domains[other] = self.get_domain(other)
+            if domains[other][0] == []:
+                wiped_out.append(other)
+        # Everything else only loses the values that overlap what was just placed
+        chunk_grid = self.chunk_grid
+        rects = []
+        for kind, chunk in node.journal:
+            if kind == 'chunk':
+                x, y = chunk_grid.chunk_positions[chunk]
+                rects.append((x, y, chunk.c_width, chunk.c_height))
+        for other, (values, reasons) in list(domains.items()):
+            if values is None or other in affected:
+                continue
+            kept = [value for value in values
+                    if not any(overlaps(value[1], value[2], value[0].c_width, value[0].c_height, *rect) for rect in rects)]
+            if len(kept) < len(values):
+                self.metrics.counters.rejected += len(values) - len(kept)
+                trail[other] = values, reasons
+                domains[other] = kept, reasons | set([node])
+                if not kept:
+                    wiped_out.append(other)
+        return trail, wiped_out
+
+    def unplace(self, node, trail):
+        for other, domain in trail.items():
+            if domain is MISSING:
+                del self.domains[other]
+            else:
+                self.domains[other] = domain
+        self.dungeon.record_progress()
+        node.undo(self.chunk_grid)
+
+    def solve(self):
+        return run_steps(self.solve_steps())
+
+    def solve_steps(self, every=None):
+        # solve as a generator, yielding every so many rounds -- see Dungeon.start_steps
+        cutoff = FIRST_RESTART
+        while True:
+            result = yield from self.search(cutoff, every)
+            if result is not None:
+                return result
+            if self.metrics.enabled:
+                self.metrics.emit('restart', cutoff=cutoff)
+            cutoff *= 2
+
+    def search(self, cutoff, every=None):
+        """
+        # Depth-first search over the nodes, with an explicit stack of frames
+        # A frame is [node, values left to try, trail of the value currently placed,
+        # placed nodes to blame if every value fails]
+        # Returns None, with everything unplaced again, after cutoff dead ends
+        # Yields every so many rounds when every is given
+        """
+        metrics = self.metrics
+        counters = metrics.counters
+        progress_log = self.dungeon.progress_log
+        entrance = self.dungeon.entrance_node
+        self.domains = {entrance: self.get_domain(entrance)}
+        stack = [self.new_frame()]
+        dead_ends = 0
+        while stack:
+            if self.dungeon.check_budget():  # Stops where it is, so the partial grid is kept
+                self.dungeon.record_progress()
+                return False
+            counters.rounds += 1
+            if every and not counters.rounds % every:
+                yield
+            if progress_log:
+                progress_log.record_round()
+            frame = stack[-1]
+            node, values, trail, conflicts = frame
+            if trail is not None:  # Take back the last value before trying the next
+                self.unplace(node, trail)
+                frame[2] = None
+            if not values:  # Dead end, so jump back to the latest node to blame
+                counters.backtracks += 1
+                dead_ends += 1
+                stack.pop()
+                if dead_ends >= cutoff and stack:
+                    while stack:
+                        jumped = stack.pop()
+                        self.unplace(jumped[0], jumped[2])
+                    return None
+                while stack and stack[-1][0] not in conflicts:
+                    jumped = stack.pop()
+                    self.unplace(jumped[0], jumped[2])
+                if metrics.enabled:
+                    metrics.emit('dead_end', node=node, depth=len(stack), to=stack[-1][0] if stack else None)
+                if stack:
+                    stack[-1][3].update(conflicts)
+                    stack[-1][3].discard(stack[-1][0])
+                continue
+            value = values.pop()
+            counters.attempts += 1
+            if not self.place(node, value):
+                conflicts.update(self.chunk_grid.conflicts)
+                conflicts.update(n for n in node.get_adj_nodes() if n.chunk)
+                continue
+            frame[2], wiped_out = self.propagate(node)
+            if wiped_out:
+                for other in wiped_out:
+                    conflicts.update(self.domains[other][1])
+                conflicts.discard(node)
+                continue
+            if not self.domains:
+                return True
+            stack.append(self.new_frame())
+        if metrics.enabled:
+            metrics.emit('total_failure', node=entrance)
+        self.dungeon.status = 'failure'
+        return False
+
+    def new_frame(self):
+        node = self.choose_node()
+        domain, reasons = self.domains[node]
+        values = [None] if domain is None else list(domain)
+        weighted_shuffle(self.rng, values, [value[0].weight if value else 1 for value in values])
+        if self.metrics.enabled:
+            self.metrics.emit('solver_choose', node=node, values=len(values) if domain is not None else 'tie_loop')
+        return [node, values, None, set(reasons)]
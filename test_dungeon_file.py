@@ -0,0 +1,59 @@
+import glob, os, random, tempfile, unittest
+
+# === my imports ===
+import constants as C
+from room_library import build_rooms
+from dungeon_generator import Dungeon
+from node_sources import random_lattice
+from budget import Budget, BUDGET_REASONS
+from dungeon_file import write_dungeon, DungeonFile, NO_NODE
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class TestDungeonFile(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        C.DEBUG = False
+        C.IM_DEBUG = False
+        cls.rooms = build_rooms(glob.glob(os.path.join(HERE, 'Rooms', '*.png')))
+
+    def round_trip(self, dungeon):
+        with tempfile.TemporaryDirectory() as tmp:
+            fp = os.path.join(tmp, 'dungeon.dgn')
+            write_dungeon(fp, dungeon)
+            with DungeonFile(fp) as f:
+                placements = f.get_placements()
+                connections = f.get_connections()
+                tiles = f.get_tiles()
+                status = f.status
+                num_nodes = f.num_nodes
+        self.assertEqual(status, dungeon.status)
+        self.assertEqual(bytes(tiles.grid), bytes(dungeon.main_grid.grid))
+        for _, _, _, nid, _ in placements:
+            self.assertTrue(nid == NO_NODE or nid < num_nodes)
+        for idx, _, _, nid in connections:
+            self.assertLess(idx, len(placements))
+            self.assertTrue(nid == NO_NODE or nid < num_nodes)
+        return placements
+
+    def test_success(self):
+        dungeon = Dungeon(self.rooms, random_lattice(6, 6, 0.5, 0, random.Random(0)), random.Random(0))
+        self.assertEqual(dungeon.status, 'success')
+        placements = self.round_trip(dungeon)
+        self.assertEqual(len(placements), len(dungeon.chunk_grid.chunks))
+
+    def test_budget_with_restarts(self):
+        # The best partial grid can come from a try before the last restart, whose nodes are gone
+        restarted = 0
+        for seed in range(6):
+            dungeon = Dungeon(self.rooms, random_lattice(12, 12, 0.5, 0.1, random.Random(seed)), random.Random(seed),
+                              budget=Budget(attempts=300, restarts=2))
+            if dungeon.status not in BUDGET_REASONS:
+                continue
+            restarted += dungeon.restarts > 0
+            placements = self.round_trip(dungeon)
+            self.assertEqual(len(placements), len(dungeon.best_chunks))
+        self.assertTrue(restarted)
+
+if __name__ == '__main__':
+    unittest.main()
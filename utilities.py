@@ -1,3 +1,5 @@
+import hashlib
+
 def opposite(direction):
     if direction == 'up':
         return 'down'
@@ -10,3 +12,39 @@ def opposite(direction):
 
 def calculate_distance(position1, position2):
     return (abs(position1[0] - position2[0]) + abs(position1[1] - position2[1]))
+
+def overlaps(x1, y1, w1, h1, x2, y2, w2, h2):
+    # Whether two rectangles share any cell
+    return x1 < x2 + w2 and x2 < x1 + w1 and y1 < y2 + h2 and y2 < y1 + h1
+
+def derive_seed(seed, *path):
+    # Child seed for a sub-task, e.g. derive_seed(batch_seed, dungeon_index)
+    # Same inputs always give the same seed, in any process
+    key = repr((seed,) + path).encode('utf-8')
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], 'little')
+
+def run_steps(steps):
+    # Runs a generator to the end and returns what it returned
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+def weighted_shuffle(rng, items, weights):
+    """
+    # Shuffles items in place so that an item of weight 2 comes before the others
+    # as often as two copies of it would
+    # Equal weights are a plain shuffle, drawing the same numbers as rng.shuffle
+    """
+    if len(set(weights)) <= 1:
+        rng.shuffle(items)
+        return
+    # Sorting by random()**(1/weight) draws items one at a time in proportion to weight
+    keys = [rng.random()**(1.0/weight) for weight in weights]
+    items[:] = [item for _, _, item in sorted(zip(keys, range(len(items)), items), reverse=True)]
+
+def weighted_choice(rng, items, weights):
+    if len(set(weights)) <= 1:
+        return rng.choice(items)
+    return rng.choices(items, weights)[0]
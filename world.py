@@ -0,0 +1,264 @@
+import argparse, collections, hashlib, io, os, random, struct
+from PIL import Image
+
+# === my imports ===
+import constants as C
+from utilities import opposite, derive_seed
+from chunk_objects import TileGrid, TILE_CODES, TILE_PALETTE, grid_to_image, hash_rooms
+from dungeon_generator import Dungeon
+from metrics import Metrics
+from room_library import load_rooms
+from node_sources import random_lattice, load_layout, split_layout, get_region, get_reachable, get_edges
+
+REGION_SIZE = 24  # Chunks along each side of a region
+REGION_LATTICE = 4  # Lattice points along each side of a region's default node map
+REGION_SPAN = REGION_LATTICE*4  # Node map pixels along each side of a region, when splitting a whole node graph
+REGION_ATTEMPTS = 10  # Seeds to try on a region before giving up
+MAX_LOADED = 16  # Regions kept in memory; the rest are read back from disk when asked for
+# Magic, region x, region y, width, height, world key, room library digest -- followed by the tiles
+REGION_HEADER = struct.Struct('<4siiHHQ16s')
+REGION_MAGIC = b'RGN2'
+
+# Side of a region, the way out of the region through it
+SIDES = {'up': (0, -1), 'left': (-1, 0), 'right': (1, 0), 'down': (0, 1)}
+
+def get_exit_tiles(room, side):
+    # Where the exit tiles are along one side of a room
+    if side in ('left', 'right'):
+        x = 0 if side == 'left' else room.width - 1
+        return tuple(y for y in range(room.height) if room.get_code(x, y) == TILE_CODES['Exit'])
+    y = 0 if side == 'up' else room.height - 1
+    return tuple(x for x in range(room.width) if room.get_code(x, y) == TILE_CODES['Exit'])
+
+def default_node_map(rx, ry, rng):
+    # A random spanning tree with a few loops, the same for a region every time
+    return random_lattice(REGION_LATTICE, REGION_LATTICE, 0.5, 0.1, rng)
+
+def write_region(fp, rx, ry, grid, key, digest):
+    # Written to a temporary file first, so a half-written region is never read
+    tmp_fp = fp + '.tmp'
+    with open(tmp_fp, 'wb') as f:
+        f.write(REGION_HEADER.pack(REGION_MAGIC, rx, ry, grid.width, grid.height, key, digest.encode('ascii')))
+        f.write(bytes(grid.grid))
+    os.replace(tmp_fp, fp)
+
+def read_region(fp, rx, ry, key, digest):
+    # Returns None unless fp holds region (rx, ry) of the same world, made from the same rooms
+    with open(fp, 'rb') as f:
+        data = f.read()
+    if len(data) < REGION_HEADER.size:
+        return None
+    magic, f_rx, f_ry, width, height, f_key, f_digest = REGION_HEADER.unpack_from(data)
+    if (magic, f_rx, f_ry, f_key, f_digest) != (REGION_MAGIC, rx, ry, key, digest.encode('ascii')):
+        return None
+    if len(data) < REGION_HEADER.size + width*height:
+        return None
+    grid = TileGrid((width, height))
+    grid.grid = bytearray(data[REGION_HEADER.size:REGION_HEADER.size + width*height])
+    return grid
+
+class World(object):
+    """
+    # An unbounded dungeon, generated one region at a time as regions are asked for
+    # Each region is its own Dungeon, kept inside a REGION_SIZE square of chunks
+    # Neighbouring regions meet at a door on their shared border. Where a door sits
+    # only depends on the seed and the border, so both sides agree on it
+    # whichever of them is generated first
+    # node_map is either called for each region with (rx, ry, rng), and returns a node
+    # map image or a node graph source keyed by position, or is a whole node graph
+    # (anything Dungeon takes, keyed by position) to split into REGION_SPAN squares.
+    # A split graph only has doors where its edges cross a border, and regions it
+    # doesn't reach are left empty
+    # Finished regions go to directory, and only the MAX_LOADED most recently used
+    # stay in memory, so memory doesn't grow with the size of the world. A region file
+    # is only used for the world and rooms it was made for, and made again otherwise
+    """
+    def __init__(self, prefab_rooms, seed=C.SEED, directory='world', node_map=default_node_map,
+                 region_size=REGION_SIZE, max_loaded=MAX_LOADED, metrics=None):
+        self.prefab_rooms = prefab_rooms
+        self.seed = seed
+        self.directory = directory
+        self.node_map = node_map
+        self.regions = None  # (rx, ry), Layout -- when splitting a whole node graph
+        self.borders = None  # Border (as get_border), (key in the region above or left, key in the other)
+        if callable(node_map):
+            source = '%s.%s' % (getattr(node_map, '__module__', ''), getattr(node_map, '__qualname__', ''))
+        else:
+            layout = load_layout(node_map)
+            self.split(layout)
+            source = hashlib.sha256(repr(list(get_edges(layout))).encode('utf-8')).hexdigest()
+        # Region files carry this, so a world never loads another world's regions
+        self.key = derive_seed(seed, 'world', source, region_size)
+        self.digest = hash_rooms(prefab_rooms)
+        self.region_size = region_size
+        self.max_loaded = max_loaded
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.loaded = collections.OrderedDict()  # (rx, ry), TileGrid -- least recently used first
+        os.makedirs(directory, exist_ok=True)
+        # Door rooms are straight corridors with their exit tiles lined up, so both
+        # regions can use the same one and their tiles meet exactly at the border
+        self.door_rooms = {}
+        for side in ('right', 'down'):
+            self.door_rooms[side] = [room for room in prefab_rooms if room.get_num_exits() == 2
+                                     and len(room.exits[side]) == 1 and len(room.exits[opposite(side)]) == 1
+                                     and get_exit_tiles(room, side) == get_exit_tiles(room, opposite(side))]
+            if not self.door_rooms[side]:
+                raise ValueError('No straight corridor room with exits %s and %s to use as a door' % (side, opposite(side)))
+
+    def split(self, layout):
+        # Regions of a whole node graph, and one door for each border its edges cross
+        self.regions, crossings = split_layout(layout, REGION_SPAN)
+        # A region's dungeon only builds what it reaches from its entrance, so a door needs that on both sides
+        reachable = {region: get_reachable(sub_layout) for region, sub_layout in self.regions.items()}
+        self.borders = {}
+        for a, direction, b in crossings:
+            if direction in ('left', 'up'):
+                a, direction, b = b, opposite(direction), a
+            ra, rb = get_region(a, REGION_SPAN), get_region(b, REGION_SPAN)
+            dx, dy = SIDES[direction]
+            if rb != (ra[0] + dx, ra[1] + dy) or a not in reachable[ra] or b not in reachable[rb]:
+                continue
+            border = (direction,) + ra
+            # Only one door per border; the edge nearest the top or left corner gets it
+            if border not in self.borders or (a, b) < self.borders[border]:
+                self.borders[border] = (a, b)
+
+    def get_region_file(self, rx, ry):
+        return os.path.join(self.directory, 'region_%d_%d.bin' % (rx, ry))
+
+    def get_region(self, rx, ry):
+        """
+        # Tiles of region (rx, ry), which covers chunks rx*region_size up to
+        # (rx + 1)*region_size across, and the same down
+        """
+        key = (rx, ry)
+        if key in self.loaded:
+            self.loaded.move_to_end(key)
+            return self.loaded[key]
+        fp = self.get_region_file(rx, ry)
+        grid = read_region(fp, rx, ry, self.key, self.digest) if os.path.exists(fp) else None
+        if grid is None:
+            grid = self.generate_region(rx, ry)
+            write_region(fp, rx, ry, grid, self.key, self.digest)
+        self.loaded[key] = grid
+        while len(self.loaded) > self.max_loaded:
+            self.loaded.popitem(last=False)
+        return grid
+
+    def get_border(self, rx, ry, side):
+        # A border is named after the region above or left of it, so both regions find the same one
+        if side == 'left':
+            return ('right', rx - 1, ry)
+        elif side == 'up':
+            return ('down', rx, ry - 1)
+        return (side, rx, ry)
+
+    def get_door(self, rx, ry, side):
+        # Room and chunk position along the border of the door on the given side of region (rx, ry)
+        key = self.get_border(rx, ry, side)
+        rooms = self.door_rooms[key[0]]
+        room = rooms[derive_seed(self.seed, 'door room', *key) % len(rooms)]
+        # Doors stay in the middle half of a side, away from the other doors
+        quarter = self.region_size//4
+        return room, quarter + derive_seed(self.seed, 'door', *key) % (self.region_size - 2*quarter)
+
+    def generate_region(self, rx, ry):
+        size = self.region_size*C.CHUNK_SIZE
+        if self.regions is not None:
+            node_map = self.regions.get((rx, ry))
+            if node_map is None:
+                return TileGrid((size, size))  # Outside the node graph
+        else:
+            rng = random.Random(derive_seed(self.seed, 'map', rx, ry))
+            node_map = self.node_map(rx, ry, rng)
+        if isinstance(node_map, Image.Image):
+            image = io.BytesIO()
+            node_map.save(image, 'PNG')
+            node_map = image
+        for attempt in range(REGION_ATTEMPTS):
+            dungeon = self.build_region(rx, ry, node_map, random.Random(derive_seed(self.seed, 'region', rx, ry, attempt)))
+            if dungeon:
+                grid = TileGrid((size, size))
+                for (x, y), chunk in dungeon.chunk_grid.chunks.items():
+                    grid.subsume(x*C.CHUNK_SIZE, y*C.CHUNK_SIZE, chunk)
+                return grid
+        raise RuntimeError('Could not generate region %d, %d in %d attempts' % (rx, ry, REGION_ATTEMPTS))
+
+    def build_region(self, rx, ry, node_map, rng):
+        """
+        # One try at a region; returns the Dungeon, or None if it didn't fit
+        # Every side with a door gets a door room placed up front on the border, joined
+        # to the node map by a new node that ties the door to a node on that side: the
+        # one furthest out, or for a split node graph, the one whose edge crossed the border
+        """
+        if hasattr(node_map, 'seek'):  # Read again on every attempt
+            node_map.seek(0)
+        dungeon = Dungeon(self.prefab_rooms, node_map, rng, build=False, metrics=self.metrics,
+                          backjump='chronological', solver=False, record=False)
+        node_dict = dungeon.build_node_graph(node_map)
+        chunk_grid = dungeon.chunk_grid
+        size = self.region_size
+        chunk_grid.bounds = (0, 0, size, size)
+        entrance = None
+        for side in C.DIRECTIONS:
+            dx, dy = SIDES[side]
+            if self.borders is not None:
+                border = self.borders.get(self.get_border(rx, ry, side))
+                if border is None:
+                    continue
+                pos = border[0] if side in ('right', 'down') else border[1]
+            else:
+                # Lattice node furthest out on this side, nearest the middle of it
+                middle = sum(pos[0] if dy else pos[1] for pos in node_dict)/len(node_dict)
+                pos = max(node_dict, key=lambda pos: (pos[0]*dx + pos[1]*dy, -abs((pos[0] if dy else pos[1]) - middle), pos))
+            lattice_node = node_dict[pos]
+            approach = dungeon.add_node()
+            door = dungeon.add_node()
+            lattice_node.add_adj_both(side, approach)
+            approach.add_adj_both(side, door)
+
+            room, door_pos = self.get_door(rx, ry, side)
+            door_exit = room.exits[side][0]
+            if side == 'right':
+                x_pos, y_pos = size - room.c_width, door_pos - door_exit.pos
+            elif side == 'left':
+                x_pos, y_pos = 0, door_pos - door_exit.pos
+            elif side == 'down':
+                x_pos, y_pos = door_pos - door_exit.pos, size - room.c_height
+            else:
+                x_pos, y_pos = door_pos - door_exit.pos, 0
+            if chunk_grid.collides(x_pos, y_pos, room):
+                return None
+            chosen_chunk = room.copy()
+            chunk_grid.place(door, x_pos, y_pos, chosen_chunk)
+            chunk_grid.assign(door, chosen_chunk)
+            chosen_chunk.get_exit(side, door_exit.pos).edge = True  # Leads out of the region, so never connect it
+            if entrance is None:
+                entrance = approach
+        if entrance is not None:
+            dungeon.entrance_node = entrance
+        if not dungeon.build_chunk_grid():
+            return None
+        return dungeon
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a block of regions of an unbounded world')
+    parser.add_argument('-s', '--seed', type=int, default=C.SEED)
+    parser.add_argument('-x', type=int, nargs=2, default=(0, 2), help='Regions from x1 up to x2')
+    parser.add_argument('-y', type=int, nargs=2, default=(0, 2), help='Regions from y1 up to y2')
+    parser.add_argument('-d', '--directory', default='world')
+    parser.add_argument('-m', '--node-map', default=None, help='Split this node graph into regions instead of making one per region')
+    parser.add_argument('-o', '--output', default='world.png', help='Image of the whole block')
+    parser.add_argument('--scale', type=int, default=2)
+    args = parser.parse_args()
+    C.DEBUG = False
+    world = World(load_rooms('Rooms/*.png'), args.seed, args.directory, args.node_map or default_node_map)
+    size = world.region_size*C.CHUNK_SIZE*args.scale
+    im = Image.new('P', ((args.x[1] - args.x[0])*size, (args.y[1] - args.y[0])*size))
+    im.putpalette(TILE_PALETTE)
+    for ry in range(*args.y):
+        for rx in range(*args.x):
+            region_im = grid_to_image(world.get_region(rx, ry), args.scale)
+            im.paste(region_im, ((rx - args.x[0])*size, (ry - args.y[0])*size))
+    im.save(args.output)
+    print('Saved %s' % args.output)